@@ -1,9 +1,14 @@
+from math import floor
+
+from redis.exceptions import ResponseError
 from redis_lock import Lock
 from rq.decorators import job
 
-from news.lib.cache import cache
+from news.lib.autocomplete import add_links
+from news.lib.cache import cache, LuaScript, DEFAULT_CACHE_TTL
 from news.clients.db.sorts import sorts
 from news.lib.metrics import CACHE_MISSES, CACHE_HITS
+from news.lib.page_cache import bump_page_generations
 from news.lib.sorts import sort_tuples
 from news.lib.task_queue import redis_conn
 from news.lib.utils.time_utils import epoch_seconds
@@ -11,6 +16,16 @@ from news.models.comment import CommentTree
 
 PRECOMPUTE_LIMIT = 1000
 
+STORAGE_PICKLE = "pickle"
+STORAGE_ZSET = "zset"
+
+# 'best' is sorted by score and then by time, both are folded into single zset score
+# as score + time / BEST_TIME_SCALE, epoch seconds always fit into the fractional part
+BEST_TIME_SCALE = 10 ** 10
+
+# marks sorted sets of feeds without any links so they don't get rebuilt on every fetch
+EMPTY_MEMBER = "_"
+
 
 def tuple_maker(sort):
     """
@@ -27,6 +42,340 @@ def tuple_maker(sort):
     return lambda x: [x.id, x.hot]  # default to trending
 
 
+def tuple_to_score(sort, item) -> float:
+    """
+    Fold sort values of tuple into single sorted set score
+    :param sort: sort
+    :param item: [id, sort value...] tuple
+    :return: score
+    """
+    if sort == "best":
+        return item[1] + item[2] / BEST_TIME_SCALE
+    return item[1]
+
+
+def score_to_tuple(sort, member, score) -> list:
+    """
+    Inverse of tuple_to_score
+    :param sort: sort
+    :param member: sorted set member (link id)
+    :param score: sorted set score
+    :return: [id, sort value...] tuple
+    """
+    if sort == "best":
+        points = floor(score)
+        return [int(member), points, round((score - points) * BEST_TIME_SCALE)]
+    return [int(member), score]
+
+
+class PickledListStore:
+    """
+    Stores every query as one pickled list of [id, sort values...] tuples
+
+    Every modification needs to read, modify and write the whole list under lock
+    """
+
+    name = STORAGE_PICKLE
+
+    def load(self, query, start=0, stop=None):
+        """
+        Load tuples of the query
+        :param query: link query
+        :param start: index of first tuple
+        :param stop: index after last tuple, None for all
+        :return: list of tuples or None if query isn't cached
+        """
+        data = cache.get(query._cache_key)
+        if data is None:
+            return None
+        return data[start:stop]
+
+    def load_many(self, queries, ranges):
+        """
+        Load tuples of multiple queries with single MGET
+        :param queries: link queries
+        :param ranges: (start, stop) for every query
+        :return: list of tuples or None for every query
+        """
+        data = cache.mget([query._cache_key for query in queries])
+        return [
+            x[start:stop] if x is not None else None
+            for x, (start, stop) in zip(data, ranges)
+        ]
+
+    def save(self, query, data):
+        cache.set(query._cache_key, data, ttl=query.ttl)
+
+    def delete(self, query, ids):
+        """
+        Delete links from the query
+        :param query: link query
+        :param ids: ids of links to delete
+        :return: True if any link was deleted
+        """
+        with Lock(cache.conn, query._lock_key):
+            # fetch fresh data from cache
+            data = cache.get(query._cache_key)
+            if data is None:
+                # nothing to delete, query gets rebuilt on next fetch
+                return False
+            kept = [x for x in data if x[0] not in ids]
+            self.save(query, kept)
+        return len(kept) != len(data)
+
+    def insert(self, query, item_tuples, rebuild=True):
+        """
+        Insert tuples into the query
+        :param query: link query
+        :param item_tuples: tuples to insert
+        :param rebuild: rebuild the query if it isn't cached, skip the insert otherwise
+        :return: True if links in the query changed, False if only their order could change
+        """
+        # read - write - modify
+        with Lock(cache.conn, query._lock_key):
+            data = self.load(query)
+            rebuilt = data is None
+            if rebuilt:
+                if not rebuild:
+                    return False
+                data = query._rebuild()
+
+            existing_fnames = {item[0] for item in data}
+            new_fnames = {item[0] for item in item_tuples}
+
+            mutated_length = len(existing_fnames.union(new_fnames))
+            would_truncate = mutated_length >= query.limit
+            if would_truncate and data:
+                # only insert items that are already stored or new items
+                # that are large enough that they won't be immediately truncated
+                # out of storage
+                # item structure is (name, sortval1[, sortval2, ...])
+                smallest = data[-1]
+                item_tuples = [
+                    item
+                    for item in item_tuples
+                    if (item[0] in existing_fnames or item[1:] >= smallest[1:])
+                ]
+
+            if not item_tuples:
+                # nothing changes
+                return rebuilt
+
+            # insert the items, remove the duplicates (keeping the
+            # one being inserted over the stored value if applicable),
+            # and sort the result
+            data = [x for x in data if x[0] not in new_fnames]
+            data.extend(item_tuples)
+            data.sort(reverse=True, key=lambda x: x[1:])
+            if len(data) > query.limit:
+                data = data[: query.limit]
+            self.save(query, data)
+        return rebuilt or {item[0] for item in data} != existing_fnames
+
+    def insert_cached(self, queries, item_tuples):
+        """
+        Insert tuples into multiple queries, queries which aren't cached are skipped
+        :param queries: link queries
+        :param item_tuples: tuples to insert for every query
+        :return: for every query True if its links changed
+        """
+        return [
+            self.insert(query, items, rebuild=False)
+            for query, items in zip(queries, item_tuples)
+        ]
+
+
+# adds members to existing sorted set and trims it to given size
+# KEYS: sorted set, ARGV: limit, ttl, score1, member1[, score2, member2...]
+# returns 0 if the set doesn't exist and needs to be rebuilt first,
+# otherwise 1 + number of added and trimmed members
+ZSET_INSERT = LuaScript(
+    """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+local changed = 0
+for i = 3, #ARGV, 2 do
+    changed = changed + redis.call('zadd', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+changed = changed + redis.call('zremrangebyrank', KEYS[1], 1, -tonumber(ARGV[1]) - 1)
+redis.call('expire', KEYS[1], ARGV[2])
+return 1 + changed
+"""
+)
+
+
+class ZSetStore:
+    """
+    Stores every query as Redis sorted set of link ids scored by the sort value
+
+    Inserts are single ZADD and trim, reads are ZREVRANGE of requested range
+    Sets of feeds without links contain only EMPTY_MEMBER scored -inf
+    so they are distinguishable from sets that aren't cached
+    """
+
+    name = STORAGE_ZSET
+
+    @staticmethod
+    def _converted(query, fnc):
+        """
+        Run the operation, convert the key if it's still stored in other format
+        :param query: link query
+        :param fnc: operation
+        :return: operation result
+        """
+        try:
+            return fnc()
+        except ResponseError:
+            if not query.migrate():
+                raise
+            return fnc()
+
+    def load(self, query, start=0, stop=None):
+        end = -1 if stop is None else stop - 1
+
+        def load_range():
+            pipe = cache.pipeline(transaction=False)
+            pipe.exists(query._cache_key)
+            pipe.zrevrange(query._cache_key, start, end, withscores=True)
+            return pipe.execute()
+
+        exists, data = self._converted(query, load_range)
+        return self.parse(query.sort, data) if exists else None
+
+    def load_many(self, queries, ranges):
+        """
+        Load tuples of multiple queries in single pipeline
+        :param queries: link queries
+        :param ranges: (start, stop) for every query
+        :return: list of tuples or None for every query
+        """
+        pipe = cache.pipeline(transaction=False)
+        for query, (start, stop) in zip(queries, ranges):
+            pipe.exists(query._cache_key)
+            pipe.zrevrange(
+                query._cache_key,
+                start,
+                -1 if stop is None else stop - 1,
+                withscores=True,
+            )
+        res = pipe.execute(raise_on_error=False)
+
+        data = []
+        for idx, (query, (start, stop)) in enumerate(zip(queries, ranges)):
+            exists, items = res[2 * idx], res[2 * idx + 1]
+            if isinstance(items, ResponseError):
+                # key is still stored in other format, load it separately
+                data.append(self.load(query, start, stop))
+            else:
+                data.append(self.parse(query.sort, items) if exists else None)
+        return data
+
+    @staticmethod
+    def parse(sort, data):
+        """
+        Parse result of ZREVRANGE with scores into list of tuples
+        :param sort: sort
+        :param data: [(member, score)...]
+        :return: list of tuples
+        """
+        return [
+            score_to_tuple(sort, member, score)
+            for member, score in data
+            if member != EMPTY_MEMBER.encode()
+        ]
+
+    def save(self, query, data):
+        scores = {EMPTY_MEMBER: float("-inf")}
+        scores.update({item[0]: tuple_to_score(query.sort, item) for item in data})
+        pipe = cache.pipeline()
+        pipe.delete(query._cache_key)
+        pipe.zadd(query._cache_key, scores)
+        pipe.expire(query._cache_key, query.ttl)
+        pipe.execute()
+
+    def delete(self, query, ids):
+        if not ids:
+            return False
+        return self._converted(query, lambda: cache.zrem(query._cache_key, *ids)) > 0
+
+    @staticmethod
+    def _insert_args(query, item_tuples):
+        args = [query.limit, query.ttl]
+        for item in item_tuples:
+            args += [tuple_to_score(query.sort, item), item[0]]
+        return args
+
+    def insert(self, query, item_tuples, rebuild=True):
+        args = self._insert_args(query, item_tuples)
+        insert = lambda: ZSET_INSERT(keys=[query._cache_key], args=args)
+        inserted = self._converted(query, insert)
+        if not inserted and rebuild:
+            query._rebuild()
+            insert()
+            return True
+        return inserted > 1
+
+    def insert_cached(self, queries, item_tuples):
+        """
+        Insert tuples into multiple queries in single pipeline
+        Queries which aren't cached are skipped
+        :param queries: link queries
+        :param item_tuples: tuples to insert for every query
+        :return: for every query True if its links changed
+        """
+        pipe = cache.pipeline(transaction=False)
+        for query, items in zip(queries, item_tuples):
+            ZSET_INSERT(
+                keys=[query._cache_key],
+                args=self._insert_args(query, items),
+                client=pipe,
+            )
+        res = pipe.execute(raise_on_error=False)
+
+        changed = []
+        for query, items, inserted in zip(queries, item_tuples, res):
+            if isinstance(inserted, ResponseError):
+                changed.append(self.insert(query, items, rebuild=False))
+            else:
+                changed.append(inserted > 1)
+        return changed
+
+
+_stores = {store.name: store for store in [PickledListStore(), ZSetStore()]}
+
+
+class QueryStorage:
+    """
+    Settings of link queries storage
+
+    Selects the storage used for link queries, pickled lists are the default,
+    sorted sets can be enabled by LINK_QUERY_STORAGE
+    Keeps default feeds whose links are precomputed in global listings
+    """
+
+    def __init__(self, app=None):
+        self.store = _stores[STORAGE_PICKLE]
+        self.default_feeds = frozenset()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Init query storage from config
+        :param app: application
+        """
+        storage = app.config["LINK_QUERY_STORAGE"]
+        if storage not in _stores:
+            raise RuntimeError('Unknown link query storage "{}"'.format(storage))
+        self.store = _stores[storage]
+        self.default_feeds = frozenset(app.config["DEFAULT_FEEDS"])
+
+
+query_storage = QueryStorage()
+
+
 class LinkQuery:
     """
     Access object for sorted links
@@ -34,7 +383,13 @@ class LinkQuery:
     Should be handled as source of truth, uses redis as store
     """
 
-    def __init__(self, feed_id, sort, time="all", filters=()):
+    # maximal number of stored links
+    limit = PRECOMPUTE_LIMIT
+
+    # expiration of stored links in seconds
+    ttl = DEFAULT_CACHE_TTL
+
+    def __init__(self, feed_id, sort, time="all", filters=(), storage=None):
         self.feed_id = feed_id
         self.sort = sort
         self.time = time
@@ -42,6 +397,7 @@ class LinkQuery:
         self._fetched = False
         self._data = None
         self._filters = filters
+        self._store = _stores[storage] if storage else query_storage.store
 
     def __iter__(self):
         self.fetch()
@@ -60,23 +416,31 @@ class LinkQuery:
     def _lock_key(self):
         return "lock:cquery:{}.{}.{}".format(self.feed_id, self.sort, self.time)
 
+    @property
+    def _page_scope(self):
+        """
+        Scope of cached pages showing the query, None if the query isn't shown on cached pages
+        """
+        return self.feed_id
+
     def _save(self):
         """
         Save data to cache
         """
         assert self._fetched
-        cache.set(self._cache_key, self._data)
+        self._store.save(self, self._data)
 
     def _rebuild(self):
         """
         Rebuild link query from database
+        :return: rebuilt list of [id, sort value...] tuples
         """
         from news.models.link import Link
 
         q = (
             Link.where("feed_id", self.feed_id)
             .order_by_raw(sorts[self.sort])
-            .limit(1000)
+            .limit(self.limit)
         )
 
         # cache needs array of objects, not a orator collection
@@ -84,95 +448,203 @@ class LinkQuery:
         self._data = sort_tuples(res)
         self._fetched = True
         self._save()
+        return self._data
 
     def delete(self, links):
         """
         Delete given links from query
         :param links: links
         """
-        with Lock(cache.conn, self._lock_key):
-            # fetch fresh data from cache
-            data = cache.get(self._cache_key) or []
-            lids = set(x.id for x in links)
-
-            data = [x for x in data if x[0] not in lids]
-            self._data = data
-            self._fetched = True
-            self._save()
+        if self._store.delete(self, {x.id for x in links}):
+            bump_page_generations([self._page_scope])
+        self._fetched = False
 
-    def insert(self, links):
+    def insert(self, links, rebuild=True):
         """
         Insert links into the query
+        Cached pages are invalidated only when links in the query change,
+        pages with outdated order of links just expire
         :param links: links to insert
-        :return: updated list of [id, sort value...] tuples
+        :param rebuild: rebuild the query if it isn't cached, skip the insert otherwise
+        :return: True
         """
-        # read - write - modify
-        with Lock(cache.conn, self._lock_key):
-            self.fetch()
-            data = self._data
-            item_tuples = [self._tupler(link) for link in links] or []
-
-            existing_fnames = {item[0] for item in data}
-            new_fnames = {item[0] for item in item_tuples}
-
-            mutated_length = len(existing_fnames.union(new_fnames))
-            would_truncate = mutated_length >= PRECOMPUTE_LIMIT
-            if would_truncate and data:
-                # only insert items that are already stored or new items
-                # that are large enough that they won't be immediately truncated
-                # out of storage
-                # item structure is (name, sortval1[, sortval2, ...])
-                smallest = data[-1]
-                item_tuples = [
-                    item
-                    for item in item_tuples
-                    if (item[0] in existing_fnames or item[1:] >= smallest[1:])
-                ]
+        item_tuples = [self._tupler(link) for link in links]
+        if item_tuples and self._store.insert(self, item_tuples, rebuild=rebuild):
+            bump_page_generations([self._page_scope])
+        self._fetched = False
+        return True
 
-            if not item_tuples:
-                # nothing changes
-                return self._data
+    @staticmethod
+    def insert_many(queries, links):
+        """
+        Insert links into multiple queries at once
+        Used for fan-out of link updates, queries which aren't cached are skipped
+        :param queries: link queries
+        :param links: links to insert
+        """
+        LinkQuery.insert_batch([(query, links) for query in queries])
 
-            # insert the items, remove the duplicates (keeping the
-            # one being inserted over the stored value if applicable),
-            # and sort the result
-            data = [x for x in data if x[0] not in new_fnames]
-            data.extend(item_tuples)
-            data.sort(reverse=True, key=lambda x: x[1:])
-            if len(data) > PRECOMPUTE_LIMIT:
-                data = data[:PRECOMPUTE_LIMIT]
-            self._data = data
-            self._fetched = True
-            self._save()
-        return True
+    @staticmethod
+    def insert_batch(updates):
+        """
+        Insert different links into multiple queries at once
+        Queries which aren't cached are skipped
+        :param updates: list of (query, links to insert)
+        """
+        merged = {}
+        for query, links in updates:
+            if query._cache_key in merged:
+                merged[query._cache_key][1].extend(links)
+            else:
+                merged[query._cache_key] = (query, list(links))
+
+        by_store = {}
+        for query, links in merged.values():
+            store_queries, item_tuples = by_store.setdefault(query._store, ([], []))
+            store_queries.append(query)
+            item_tuples.append([query._tupler(link) for link in links])
+
+        scopes = []
+        for store, (store_queries, item_tuples) in by_store.items():
+            changed = store.insert_cached(store_queries, item_tuples)
+            scopes += [
+                query._page_scope
+                for query, query_changed in zip(store_queries, changed)
+                if query_changed
+            ]
+        bump_page_generations(scopes)
+
+    def _load_range(self, start, stop):
+        """
+        Range of tuples which needs to be loaded from the store
+        Filters need to see all tuples before slicing
+        """
+        return (0, None) if self._filters else (start, stop)
 
-    def fetch(self):
+    def _finish_fetch(self, data, start, stop):
         """
-        Fetch data from cache and return them
-        Data are tuples in from [id, [sort value 1, [sort value 2, ...]]]
+        Rebuild the query if it wasn't cached, apply filters and slice loaded data
+        :param data: data loaded from store with range from _load_range
+        :param start: index of first tuple to fetch
+        :param stop: index after last tuple to fetch, None for all
         :return: sorted and filtered list of [id, sort values...] tuples
         """
-        self._data = cache.get(self._cache_key)
-
-        if self._data is None:
+        if data is None:
             CACHE_MISSES.inc(1)
-            self._rebuild()
+            data = self._rebuild()[slice(*self._load_range(start, stop))]
         else:
             CACHE_HITS.inc(1)
 
-        self._fetched = True
-
         for fnc in self._filters:
-            self._data = filter(fnc, self._data)
+            data = filter(fnc, data)
 
+        if self._filters:
+            data = list(data)[start:stop]
+
+        self._data = data
+        self._fetched = True
         return self._data
 
-    def fetch_ids(self) -> [str]:
+    def fetch(self, start=0, stop=None):
+        """
+        Fetch data from cache and return them
+        Data are tuples in from [id, [sort value 1, [sort value 2, ...]]]
+        :param start: index of first tuple to fetch
+        :param stop: index after last tuple to fetch, None for all
+        :return: sorted and filtered list of [id, sort values...] tuples
+        """
+        data = self._store.load(self, *self._load_range(start, stop))
+        return self._finish_fetch(data, start, stop)
+
+    @staticmethod
+    def fetch_many(queries, start=0, stop=None):
+        """
+        Fetch data of multiple queries at once
+        Queries are loaded in single round trip per storage instead of one by one
+        :param queries: link queries
+        :param start: index of first tuple to fetch from every query
+        :param stop: index after last tuple to fetch from every query, None for all
+        :return: list of fetched data for every query in the same order
+        """
+        by_store = {}
+        for query in queries:
+            by_store.setdefault(query._store, []).append(query)
+
+        for store, store_queries in by_store.items():
+            ranges = [query._load_range(start, stop) for query in store_queries]
+            for query, data in zip(
+                store_queries, store.load_many(store_queries, ranges)
+            ):
+                query._finish_fetch(data, start, stop)
+
+        return [query._data for query in queries]
+
+    def fetch_ids(self, start=0, stop=None) -> [str]:
         """
         Fetch data from cache but return only ids of things
+        :param start: index of first id to fetch
+        :param stop: index after last id to fetch, None for all
         :return: sorted and filtered list of ids
         """
-        return [r[0] for r in self.fetch()]
+        return [r[0] for r in self.fetch(start, stop)]
+
+    def migrate(self):
+        """
+        Convert cached query into configured storage format
+        Queries which aren't cached or are already converted are left untouched
+        """
+        with Lock(cache.conn, self._lock_key):
+            kind = cache.type(self._cache_key)
+            if kind == b"string" and self._store.name != STORAGE_PICKLE:
+                data = cache.get(self._cache_key)
+            elif kind == b"zset" and self._store.name != STORAGE_ZSET:
+                data = ZSetStore.parse(
+                    self.sort, cache.zrevrange(self._cache_key, 0, -1, withscores=True),
+                )
+            else:
+                return False
+            self._data = data
+            self._fetched = True
+            self._save()
+        return True
+
+
+class GlobalLinkQuery(LinkQuery):
+    """
+    Precomputed listing of links from all default feeds
+
+    Anonymous front pages read this single listing instead of merging listings of all default feeds
+    on every request, it's kept up to date together with listings of individual feeds
+    """
+
+    def __init__(self, sort, time="all", storage=None):
+        super().__init__("global", sort, time=time, storage=storage)
+
+    def __repr__(self):
+        return "<GlobalQuery %s>" % self.sort
+
+    @staticmethod
+    def includes(link) -> bool:
+        """
+        Does the link belong to global listings?
+        :param link: link
+        :return: True if link was posted to one of default feeds
+        """
+        return link.feed_id in query_storage.default_feeds
+
+    def _rebuild(self):
+        """
+        Rebuild global listing by merging listings of default feeds
+        :return: rebuilt list of [id, sort value...] tuples
+        """
+        from news.lib.normalized_listing import merged_tuples
+
+        self._data = merged_tuples(
+            sorted(query_storage.default_feeds), self.sort, self.limit
+        )
+        self._fetched = True
+        self._save()
+        return self._data
 
 
 @job("medium", connection=redis_conn)
@@ -185,5 +657,39 @@ def JOB_add_to_queries(link):
     for sort in ["trending", "best", "new"]:
         q = LinkQuery(feed_id=link.feed_id, sort=sort)
         q.insert([link])
+        if GlobalLinkQuery.includes(link):
+            GlobalLinkQuery(sort).insert([link])
+
+    from news.lib.home_listing import update_home_listings
+
+    update_home_listings(link, ["trending", "best", "new"])
     CommentTree(link.id).create()
+    add_links([link])
+    return None
+
+
+@job("medium", connection=redis_conn)
+def JOB_add_links_to_queries(links):
+    """
+    Add multiple new links to queries at once
+    Every listing is updated with single batched insert, listings which aren't cached are skipped
+    as they get rebuilt from database with the new links
+    :param links: new links
+    :return: nothing
+    """
+    from news.lib.home_listing import home_listing_updates
+
+    sorts = ["trending", "best", "new"]
+    updates = []
+    for link in links:
+        for sort in sorts:
+            updates.append((LinkQuery(feed_id=link.feed_id, sort=sort), [link]))
+            if GlobalLinkQuery.includes(link):
+                updates.append((GlobalLinkQuery(sort), [link]))
+    updates += home_listing_updates(links, sorts)
+    LinkQuery.insert_batch(updates)
+
+    for link in links:
+        CommentTree(link.id).create()
+    add_links(links)
     return None
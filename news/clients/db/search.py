@@ -1,8 +1,25 @@
 from datetime import datetime, timedelta
+from hashlib import md5
 
+from flask import current_app
+
+from news.clients.db.db import db
+from news.lib.cache import cache
 from news.models.feed import Feed
 from news.models.link import Link
 
+# matches are counted only up to this number
+HITS_LIMIT = 1000
+
+# seconds search results are cached for
+SEARCH_CACHE_TTL = 60
+
+# weights of searchable columns in ranking, in order of __searchable__
+WEIGHTS = "ABCD"
+
+SEARCH_COLUMNS = "columns"
+SEARCH_WEIGHTED = "weighted"
+
 
 def time_string_to_timedelta(timestr):
     return {
@@ -13,57 +30,150 @@ def time_string_to_timedelta(timestr):
     }[timestr]
 
 
+def normalize_query(q: str) -> str:
+    """
+    Normalize search query so equal queries share cached results
+    :param q: query
+    :return: normalized query
+    """
+    return " ".join((q or "").lower().split())
+
+
 class Search:
     """
     Search
+
+    Matches are ranked by ts_rank with earlier searchable columns weighted higher,
+    headlines are computed only for the returned page
+    SEARCH_MODE selects between vectors of separate columns and single weighted vector
     """
 
     def __init__(self, cls, sorts, default_sort=None):
         self._cls = cls
         self._sorts = sorts
         self._default_sort = default_sort
-
-        # prepare select statement with highlighting
-        highlight_select = [
-            "ts_headline('english', \"{}\", plainto_tsquery('english', '\"{}\"')) AS {}_highlight".format(
-                column, "{q}", column
-            )
-            for column in self._cls.__searchable__
-        ]
-        select_fields = ["*"] + highlight_select + ["count(*) OVER() AS full_count"]
-        if self._cls.__timestamps__:
-            select_fields += ["created_at", "updated_at"]
-        self._select_statement = ", ".join(select_fields)
-
-        # create where statement
-        where_clauses = [
-            "textsearchable_{} @@ to_tsquery('english', '{}')".format(column, "{q}")
-            for column in self._cls.__searchable__
-        ]
-        self._where_statement = " OR ".join(where_clauses)
-
-    def search(self, q, sort=None, time=None):
-        # parse query
-        q = " & ".join(q.split())
-
-        data = self._cls.select_raw(self._select_statement.format(q=q))
-
-        if time is None or time is "all":
-            data = data.where_raw(self._where_statement.format(q=q))
-        else:
-            data = data.where_raw(
-                "({}) AND created_at >= {}".format(
-                    self._where_statement.format(q=q),
-                    datetime.utcnow() - time_string_to_timedelta(time),
-                )
-            )
-
-        if sort in self._sorts:
-            data = data.order_by_raw(self._sorts[sort])
-
-        data = data.limit(30)
-
-        return data.get()
+        self.hits_limit = HITS_LIMIT
+
+        columns = self._cls.__searchable__
+        # (match, rank) of search modes
+        self._modes = {
+            # separate vector and index per column
+            SEARCH_COLUMNS: (
+                " OR ".join(
+                    "textsearchable_{} @@ query".format(column) for column in columns
+                ),
+                "ts_rank({}, query)".format(
+                    " || ".join(
+                        "setweight(coalesce(textsearchable_{}, ''), '{}')".format(
+                            column, weight
+                        )
+                        for column, weight in zip(columns, WEIGHTS)
+                    )
+                ),
+            ),
+            # single weighted vector of all columns with single index
+            SEARCH_WEIGHTED: (
+                "textsearchable @@ query",
+                "ts_rank(textsearchable, query)",
+            ),
+        }
+        self._headlines = ", ".join(
+            "ts_headline('english', \"{0}\", query) AS {0}_highlight".format(column)
+            for column in columns
+        )
+
+    def _where(self, mode, time):
+        """
+        Where clause and its bindings
+        :param mode: search mode
+        :param time: time limit
+        :return: where clause, bindings
+        """
+        match, _ = self._modes[mode]
+        if time is None or time == "all":
+            return "({})".format(match), []
+        return (
+            "({}) AND created_at >= %s".format(match),
+            [datetime.utcnow() - time_string_to_timedelta(time)],
+        )
+
+    def _page(self, mode, q, sort, time, offset, limit) -> [dict]:
+        """
+        Find page of matching items
+        :return: rows with id and headlines of searchable columns
+        """
+        where, bindings = self._where(mode, time)
+        order = "{}, id DESC".format(self._sorts.get(sort, "rank DESC"))
+        query = (
+            "SELECT page.id, {headlines} FROM ("
+            "SELECT {table}.*, {rank} AS rank "
+            "FROM {table}, plainto_tsquery('english', %s) AS query "
+            "WHERE {where} ORDER BY {order} LIMIT %s OFFSET %s"
+            ") AS page, plainto_tsquery('english', %s) AS query "
+            "ORDER BY {order}"
+        ).format(
+            headlines=self._headlines,
+            table=self._cls.__table__,
+            rank=self._modes[mode][1],
+            where=where,
+            order=order,
+        )
+        return db.select(query, [q] + bindings + [limit, offset, q])
+
+    def _hits(self, mode, q, time) -> int:
+        """
+        Count matching items up to the hits limit
+        """
+        where, bindings = self._where(mode, time)
+        query = (
+            "SELECT count(*) AS hits FROM ("
+            "SELECT 1 FROM {table}, plainto_tsquery('english', %s) AS query "
+            "WHERE {where} LIMIT %s"
+            ") AS capped"
+        ).format(table=self._cls.__table__, where=where)
+        return db.select(query, [q] + bindings + [self.hits_limit])[0]["hits"]
+
+    def search(self, q, sort=None, time=None, offset=0, limit=30):
+        """
+        Search items
+        Results are cached by normalized query, sort, time limit and page
+        :param q: query
+        :param sort: sort, defaults to rank
+        :param time: time limit, "day", "week", "month", "year" or "all"
+        :param offset: number of skipped results
+        :param limit: number of results
+        :return: items with highlighted searchable columns, hits up to hits limit, has more results
+        """
+        q = normalize_query(q)
+        if not q:
+            return [], 0, False
+        if sort not in self._sorts:
+            sort = self._default_sort
+        if time not in ["day", "week", "month", "year"]:
+            time = "all"
+
+        mode = current_app.config["SEARCH_MODE"]
+
+        cache_key = "search:{}:{}".format(
+            self._cls.__table__,
+            md5(
+                "{}|{}|{}|{}|{}|{}".format(mode, q, sort, time, offset, limit).encode()
+            ).hexdigest(),
+        )
+        results = cache.get(cache_key)
+        if results is None:
+            rows = self._page(mode, q, sort, time, offset, limit + 1)
+            results = ([dict(row) for row in rows], self._hits(mode, q, time))
+            cache.set(cache_key, results, ttl=SEARCH_CACHE_TTL)
+        rows, hits = results
+
+        page = rows[:limit]
+        items = self._cls.by_ids([row["id"] for row in page]) if page else []
+        for item, row in zip(items, page):
+            if item is not None:
+                for column in self._cls.__searchable__:
+                    setattr(item, column + "_highlight", row[column + "_highlight"])
+        return [item for item in items if item is not None], hits, len(rows) > limit
 
 
 link_search = Search(
@@ -6,9 +6,13 @@ from news.config.config import load_config, register_functions
 from news.config.routes import register_routes
 from news.clients.amazons3 import S3
 from news.lib.cache import cache
+from news.lib.counters import counters
+from news.clients.db.query import query_storage
+from news.lib.home_listing import home_listings
 from news.lib.csrf import csrf
 from news.clients.db.db import db
 from news.lib.login import login_manager
+from news.lib.ratelimit import local_limits
 from news.clients.sentry import sentry
 
 
@@ -31,6 +35,14 @@ def real_make_app():
 
     cache.init_app(app)
 
+    query_storage.init_app(app)
+
+    home_listings.init_app(app)
+
+    counters.init_app(app)
+
+    local_limits.init_app(app)
+
     login_manager.init_app(app)
 
     S3.init_app(app)
@@ -90,11 +90,62 @@ def load_config(app):
     # REDIS CONFIG
     app.config["REDIS_URL"] = get_string("REDIS_URL")
 
+    # codec of cached values, "pickle" or "struct"
+    # values written by either codec can be read so it can be switched without flushing Redis
+    app.config["CACHE_CODEC"] = get_string("CACHE_CODEC", "pickle")
+
+    # seconds between writes of accumulated counter changes to database, 0 writes them immediately
+    app.config["COUNTER_FLUSH_INTERVAL"] = get_int("COUNTER_FLUSH_INTERVAL", 0)
+
+    # process local caches in front of Redis, key prefix -> [size, ttl in seconds]
+    app.config["LOCAL_CACHE"] = (
+        json.loads(os.getenv("LOCAL_CACHE"))
+        if os.getenv("LOCAL_CACHE")
+        else {
+            "f:": [1000, 300],
+            "fslug:": [1000, 300],
+            "u:": [5000, 60],
+            "uname:": [5000, 300],
+        }
+    )
+
+    # clients tracked by process local rate limit buckets in front of Redis, 0 disables them
+    app.config["RATE_LIMIT_LOCAL_SIZE"] = get_int("RATE_LIMIT_LOCAL_SIZE", 10000)
+
+    # full-text search over "columns" with own vectors or single "weighted" vector
+    # "weighted" needs columns added by migration 2026_10_18_120000_add_weighted_search_vectors
+    app.config["SEARCH_MODE"] = get_string("SEARCH_MODE", "columns")
+
+    # storage of sorted link listings, "pickle" or "zset"
+    app.config["LINK_QUERY_STORAGE"] = get_string("LINK_QUERY_STORAGE", "pickle")
+
+    # comments displayed at once, the rest is loaded through continuations
+    app.config["COMMENTS_PAGE_SIZE"] = get_int("COMMENTS_PAGE_SIZE", 50)
+    app.config["COMMENTS_MAX_DEPTH"] = get_int("COMMENTS_MAX_DEPTH", 8)
+    app.config["COMMENTS_MAX_CHILDREN"] = get_int("COMMENTS_MAX_CHILDREN", 20)
+    # seconds rendered comments are cached for, 0 disables the cache
+    app.config["COMMENTS_CACHE_TTL"] = get_int("COMMENTS_CACHE_TTL", 60)
+
+    # seconds whole pages are cached for anonymous users, 0 disables the cache
+    app.config["PAGE_CACHE_TTL"] = get_int("PAGE_CACHE_TTL", 30)
+
     app.config["DEFAULT_FEEDS"] = (
         json.loads(os.getenv("DEFAULT_FEEDS"))
         if os.getenv("DEFAULT_FEEDS")
         else range(100)
     )
+    # materialized home listings of logged in users
+    app.config["HOME_LISTINGS"] = get_bool("HOME_LISTINGS", False)
+    app.config["HOME_LISTING_SIZE"] = get_int("HOME_LISTING_SIZE", 300)
+    app.config["HOME_LISTING_MAX_USERS"] = get_int("HOME_LISTING_MAX_USERS", 10000)
+    app.config["HOME_LISTING_INACTIVITY"] = get_int(
+        "HOME_LISTING_INACTIVITY", 6 * 60 * 60
+    )
+    # seconds between drops of inactive home listings
+    app.config["HOME_LISTING_PRUNE_INTERVAL"] = get_int(
+        "HOME_LISTING_PRUNE_INTERVAL", 60
+    )
+
     app.config["DEFAULT_SUBSCRIBED_FEEDS"] = (
         json.loads(os.getenv("DEFAULT_SUBSCRIBED_FEEDS"))
         if os.getenv("DEFAULT_FEEDS")
@@ -129,6 +129,7 @@ def register_routes(app):
         Route("/l/<link:link>/report", post_link_report, methods=["POST"]),
         Route("/l/<link:link>/comment", comment_link, methods=["POST"]),
         Route("/l/<link:link>/save", save_link),
+        Route("/l/<link:link>/comments/<continuation>", get_link_comments),
         Route("/l/<link:link>/vote/<vote_str>", do_vote),
         Route("/l/<link:link>/<link_slug>", get_link),
         # COMMENTS
@@ -144,6 +145,7 @@ def register_routes(app):
         Route("/saved", saved_links),
         # SEARCH
         Route("/search", search),
+        Route("/autocomplete", autocomplete),
         # SETTINGS
         Route("/settings", settings),
         Route("/settings/profile", profile_settings, methods=["GET", "POST"]),
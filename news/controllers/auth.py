@@ -27,7 +27,7 @@ def signup():
     )
 
 
-@rate_limit("join", 10, 3600, limit_user=False, limit_ip=True)
+@rate_limit("join", 10, 3600, limit_user=False, limit_ip=True, local=True)
 def post_signup():
     """
     Sign Up new user
@@ -66,7 +66,7 @@ def login():
     )
 
 
-@rate_limit("login", 10, 300, limit_user=False, limit_ip=True)
+@rate_limit("login", 10, 300, limit_user=False, limit_ip=True, local=True)
 def post_login():
     """
     Login existing user
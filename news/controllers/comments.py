@@ -80,6 +80,6 @@ def do_comment_vote(comment, vote_str=None):
         abort(404)
 
     vote = CommentVote(user_id=current_user.id, comment_id=comment.id, vote_type=vote)
-    vote.apply()
+    vote.apply(comment)
 
     return redirect(redirect_back(comment.link.route))
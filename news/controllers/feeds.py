@@ -9,9 +9,11 @@ from news.lib.access import feed_admin_required, not_banned
 from news.clients.amazons3 import S3
 from news.clients.db.query import LinkQuery
 from news.lib.filters import min_score_filter
-from news.lib.pagination import paginate
+from news.lib.fqs_scheduler import schedule, unschedule
+from news.lib.page_cache import cached_page, feed_page
+from news.lib.pagination import paginate_query
 from news.lib.ratelimit import rate_limit
-from news.lib.rss import rss_page
+from news.lib.rss import rss_response
 from news.lib.utils.file_type import imagefile
 from news.lib.utils.redirect import redirect_back
 from news.lib.utils.time_utils import convert_to_timedelta
@@ -22,6 +24,7 @@ from news.models.fully_qualified_source import FullyQualifiedSource
 from news.models.link import LinkForm, Link
 from news.models.report import Report
 from news.models.user import User
+from news.scripts.import_fqs import update_sources
 
 
 @login_required
@@ -38,6 +41,7 @@ def new_feed():
     return render_template("new_feed.html", form=form)
 
 
+@cached_page(feed_page)
 @not_banned
 def get_feed(feed, sort=None):
     """
@@ -52,10 +56,9 @@ def get_feed(feed, sort=None):
     if sort is None:
         sort = feed.default_sort
 
-    ids, has_less, has_more = paginate(
-        LinkQuery(feed_id=feed.id, sort=sort).fetch_ids(), 20
-    )
+    ids, has_less, has_more = paginate_query(LinkQuery(feed_id=feed.id, sort=sort), 20)
     links = Link.by_ids(ids) if len(ids) > 0 else []
+    Link.preload(links, user=current_user)
 
     if sort == "new" and current_user.is_authenticated:
         links = filter(min_score_filter(current_user.p_min_link_score), links)
@@ -73,9 +76,8 @@ def get_feed_rss(feed):
     :param feed: feed
     :return:
     """
-    ids, _, _ = paginate(LinkQuery(feed_id=feed.id, sort="trending").fetch_ids(), 30)
-    links = Link.by_ids(ids)
-    return rss_page(feed, links)
+    ids, _, _ = paginate_query(LinkQuery(feed_id=feed.id, sort="trending"), 30)
+    return rss_response(feed, ids)
 
 
 @login_required
@@ -303,6 +305,7 @@ def post_feed_fqs(feed):
             url=url, update_interval=period, feed_id=feed.id, next_update=datetime.now()
         )
         fqs.save()
+        schedule([fqs])
     return redirect("{}/fqs".format(feed.route))
 
 
@@ -310,25 +313,7 @@ def post_feed_fqs(feed):
 def update_fqs(_, fqs_id):
     source = FullyQualifiedSource.by_id(fqs_id)
 
-    try:
-        articles = source.get_links()
-
-        for article in articles:
-            # skip if article already posted
-            if Link.by_slug(article["slug"]) is not None:
-                continue
-            link = Link(
-                title=article["title"],
-                slug=article["slug"],
-                text=article["text"],
-                url=article["url"],
-                feed_id=source.feed_id,
-                user_id=12345,
-            )
-            link.commit()
-        source.next_update = datetime.now() + timedelta(seconds=source.update_interval)
-        source.save()
-    except Exception as e:
+    if update_sources([source]):
         flash("Could not parse the RSS feed on URL".format(source.url), "error")
 
     return redirect(redirect_back(source.feed.route))
@@ -340,5 +325,6 @@ def remove_fqs(_, fqs_id):
     back = source.feed.route
     if source:
         source.delete()
+        unschedule(source.id)
 
     return redirect(redirect_back(back))
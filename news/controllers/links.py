@@ -1,16 +1,74 @@
-from flask import render_template, flash, abort
+from flask import render_template, flash, abort, current_app, request
 from flask_login import login_required, current_user
 from werkzeug.utils import redirect
 
+from news.lib.comments import cached_comments
+from news.lib.page_cache import cached_page, link_page
 from news.lib.ratelimit import rate_limit
 from news.lib.utils.redirect import redirect_back
 from news.models.ban import Ban
-from news.models.comment import SortedComments, CommentForm
+from news.models.comment import SortedComments, CommentForm, parse_continuation
 from news.models.link import SavedLink
 from news.models.report import ReportForm, Report
 from news.models.vote import vote_type_from_string, LinkVote
 
 
+def _comment_thread(link, parent_id=None, offset=0) -> dict:
+    """
+    Render comments of link
+    Comments are cached per variant, only votes of the viewer are marked on each request
+    :param link: link
+    :param parent_id: parent comment id
+    :param offset: number of skipped children of the parent comment
+    :return: template arguments of the comment thread
+    """
+
+    def render():
+        # Currently supports only one type of sorting for comments
+        comments, more = SortedComments(link.id).build_tree(
+            parent_id=parent_id,
+            offset=offset,
+            limit=current_app.config["COMMENTS_PAGE_SIZE"]
+            if parent_id is None
+            else current_app.config["COMMENTS_MAX_CHILDREN"],
+            depth=current_app.config["COMMENTS_MAX_DEPTH"],
+            children=current_app.config["COMMENTS_MAX_CHILDREN"],
+        )
+        html = render_template(
+            "comment_tree.html", link=link, comments=comments, more=more
+        )
+        ids, stack = [], list(comments)
+        while stack:
+            comment, subcomments, _ = stack.pop()
+            ids.append(comment.id)
+            stack.extend(subcomments)
+        return html, ids
+
+    upvotes, downvotes = [], []
+    if current_user.is_authenticated and current_user.is_feed_admin(link.feed):
+        # admins see reports which aren't versioned by comments generation
+        html, ids = render()
+    else:
+        variant = "{}{}.{}.{}".format(
+            "u" if current_user.is_authenticated else "a",
+            int(link.archived),
+            parent_id or 0,
+            offset,
+        )
+        html, ids = cached_comments(link.id, variant, render)
+
+    if current_user.is_authenticated:
+        upvotes = [id for id in ids if str(id).encode() in current_user.comment_upvotes]
+        downvotes = [
+            id for id in ids if str(id).encode() in current_user.comment_downvotes
+        ]
+
+    return dict(
+        comments_html=html, comment_upvotes=upvotes, comment_downvotes=downvotes
+    )
+
+
+@cached_page(link_page)
 def get_link(link, link_slug=""):
     """
     Default view page for link
@@ -23,20 +81,46 @@ def get_link(link, link_slug=""):
     ):
         abort(403)
 
-    # Currently supports only one type of sorting for comments
-    sorted_comments = SortedComments(link.id).get_full_tree()
-
     return render_template(
         "link.html",
         link=link,
         feed=link.feed,
         comment_form=CommentForm(),
-        comments=sorted_comments,
+        **_comment_thread(link)
+    )
+
+
+def get_link_comments(link, continuation):
+    """
+    Continuation of comments of link
+    Renders only the comments for asynchronous requests, whole link page otherwise
+    :param link: link
+    :param continuation: continuation token
+    :return:
+    """
+    if (
+        current_user.is_authenticated
+        and Ban.by_user_and_feed(current_user, link.feed) is not None
+    ):
+        abort(403)
+
+    try:
+        parent_id, offset = parse_continuation(continuation)
+    except ValueError:
+        abort(404)
+
+    thread = _comment_thread(link, parent_id, offset)
+
+    if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        return render_template("link_comments.html", **thread)
+
+    return render_template(
+        "link.html", link=link, feed=link.feed, comment_form=CommentForm(), **thread
     )
 
 
 @login_required
-@rate_limit("vote", 20, 100, limit_user=True, limit_ip=False)
+@rate_limit("vote", 20, 100, limit_user=True, limit_ip=False, local=True)
 def do_vote(link, vote_str=None):
     """
     Vote on link
@@ -56,7 +140,7 @@ def do_vote(link, vote_str=None):
 
     vote = vote_type_from_string(vote_str)
     vote = LinkVote(user_id=current_user.id, link_id=link.id, vote_type=vote)
-    vote.apply()
+    vote.apply(link)
 
     return redirect(redirect_back(link.route))
 
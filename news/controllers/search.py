@@ -1,24 +1,59 @@
 import time
 
-from flask import request, render_template
+from flask import request, render_template, jsonify
 
 from news.clients.db.search import link_search, feed_search
+from news.lib.autocomplete import complete
+from news.models.link import Link
+
+PAGE_SIZE = 30
 
 
 def search():
     q = request.args.get("q")
+    sort = request.args.get("sort")
+    time_limit = request.args.get("time")
+    count = max(request.args.get("count", default=0, type=int), 0)
 
     start = time.perf_counter()
 
-    links = link_search.search(q)
-    feeds = feed_search.search(q)
+    links, link_hits, has_more = link_search.search(
+        q, sort=sort, time=time_limit, offset=count, limit=PAGE_SIZE
+    )
+    Link.preload(links)
+    # feeds are shown only on the first page
+    feeds, feed_hits, _ = (
+        feed_search.search(q, limit=PAGE_SIZE) if count == 0 else ([], 0, False)
+    )
 
     end = time.perf_counter()
 
-    hits = sum([x[0].full_count if len(x) > 0 else 0 for x in [links, feeds]])
+    hits = link_hits + feed_hits
+    capped = link_hits >= link_search.hits_limit or feed_hits >= feed_search.hits_limit
 
-    search_info = {"elapsed": "{0:.3f}".format(end - start), "hits": hits}
+    search_info = {
+        "elapsed": "{0:.3f}".format(end - start),
+        "hits": "{}+".format(hits) if capped else hits,
+    }
 
     return render_template(
-        "search.html", links=links, q=q, search_info=search_info, feeds=feeds
+        "search.html",
+        links=links,
+        q=q,
+        sort=sort,
+        time=time_limit,
+        search_info=search_info,
+        feeds=feeds,
+        less_links=max(0, count - PAGE_SIZE) if count > 0 else None,
+        more_links=count + PAGE_SIZE if has_more else None,
     )
+
+
+def autocomplete():
+    """
+    Complete feeds and recent link titles as the user types
+    Served only from the prefix index in Redis
+    :return: json with feeds and links
+    """
+    feeds, links = complete(request.args.get("q", ""))
+    return jsonify(feeds=feeds, links=links)
@@ -56,6 +56,7 @@ def users_posts(username):
     if user is None:
         abort(404)
     links, less, more = paginate(user.links, 20)
+    Link.preload(links, user=current_user)
     return render_template(
         "profile_posts.html",
         user=user,
@@ -68,8 +69,10 @@ def users_posts(username):
 
 @login_required
 def saved_links():
-    links = SavedLink.by_user(current_user)
-    links, less, more = paginate(links, 20)
+    saved = SavedLink.by_user(current_user)
+    saved, less, more = paginate(saved, 20)
+    links = Link.by_ids([x.link_id for x in saved]) if saved else []
+    Link.preload(links, user=current_user)
     return render_template(
         "saved_links.html",
         user=current_user,
@@ -1,13 +1,15 @@
-from feedgen.feed import FeedGenerator
 from flask import render_template, request, current_app
 from flask.views import View
 from flask_login import current_user
 from prometheus_client import core
 from prometheus_client.exposition import generate_latest
 
+from news.clients.db.query import GlobalLinkQuery
+from news.lib.home_listing import home_listings, home_query
 from news.lib.normalized_listing import trending_links, best_links, new_links
-from news.lib.pagination import paginate
-from news.lib.rss import rss_entries
+from news.lib.page_cache import cached_page, global_page
+from news.lib.pagination import paginate, page_limit, paginate_query
+from news.lib.rss import rss_response
 from news.models.link import Link
 
 
@@ -31,24 +33,36 @@ class CommonListing(LinksListing):
         return current_app.config["DEFAULT_FEEDS"]
 
 
+@cached_page(global_page)
 def index():
     sort = None
-    if current_user.is_authenticated:
+    if current_user.is_authenticated and home_listings.enabled:
+        s = request.args.get("sort", "trending")
+        if s not in ["trending", "new", "best"]:
+            s = "best"
+        sort = s.capitalize()
+        paginated_ids, has_less, has_more = paginate_query(
+            home_query(current_user, s), 20
+        )
+    elif current_user.is_authenticated:
         s = request.args.get("sort", "trending")
         if s == "trending":
-            links = trending_links(current_user.subscribed_feed_ids)
+            links = trending_links(current_user.subscribed_feed_ids, page_limit(20))
             sort = "Trending"
         elif s == "new":
-            links = new_links(current_user.subscribed_feed_ids)
+            links = new_links(current_user.subscribed_feed_ids, page_limit(20))
             sort = "New"
         else:
-            links = best_links(current_user.subscribed_feed_ids, "all")
+            links = best_links(current_user.subscribed_feed_ids, "all", page_limit(20))
             sort = "Best"
+        paginated_ids, has_less, has_more = paginate(links, 20)
     else:
-        links = trending_links(current_app.config["DEFAULT_FEEDS"])
+        paginated_ids, has_less, has_more = paginate_query(
+            GlobalLinkQuery("trending"), 20
+        )
     count = request.args.get("count", default=None, type=int)
-    paginated_ids, has_less, has_more = paginate(links, 20)
     links = Link.by_ids(paginated_ids) if paginated_ids else []
+    Link.preload(links, user=current_user)
     return render_template(
         "index.html",
         links=links,
@@ -63,30 +77,18 @@ def index():
 
 def index_rss():
     if current_user.is_authenticated:
-        links = trending_links(current_user.subscribed_feed_ids)
+        links = trending_links(current_user.subscribed_feed_ids, page_limit(30))
+        paginated_ids, _, _ = paginate(links, 30)
     else:
-        links = trending_links(current_app.config["DEFAULT_FEEDS"])
-    paginated_ids, _, _ = paginate(links, 30)
-    links = Link.by_ids(paginated_ids)
-
-    # TODO maybe do through fake feed (that's what reddit does and it actually makes sense)
-    fg = FeedGenerator()
-    fg.id("https://localhost:5000/")
-    fg.title("Newsfeed")
-    fg.link(href="http://localhost:5000/", rel="self")
-    fg.description("Global news agrregator!")
-    fg.language("en")
-
-    for entry in rss_entries(links):
-        fg.add_entry(entry)
-
-    return fg.rss_str(pretty=True)
+        paginated_ids, _, _ = paginate_query(GlobalLinkQuery("trending"), 30)
+    return rss_response(None, paginated_ids, public=not current_user.is_authenticated)
 
 
+@cached_page(global_page)
 def new():
-    links = new_links(current_app.config["DEFAULT_FEEDS"])
-    paginated_ids, has_less, has_more = paginate(links, 20)
+    paginated_ids, has_less, has_more = paginate_query(GlobalLinkQuery("new"), 20)
     links = Link.by_ids(paginated_ids)
+    Link.preload(links, user=current_user)
 
     return render_template(
         "index.html",
@@ -97,13 +99,19 @@ def new():
     )
 
 
+@cached_page(global_page)
 def best():
     time = request.args.get("time")
-    links = best_links(
-        current_app.config["DEFAULT_FEEDS"], time_limit=time if time else "all"
-    )
-    paginated_ids, has_less, has_more = paginate(links, 20)
+    if time and time != "all":
+        # global listing keeps only the best links of all time
+        links = best_links(
+            current_app.config["DEFAULT_FEEDS"], time_limit=time, limit=page_limit(20)
+        )
+        paginated_ids, has_less, has_more = paginate(links, 20)
+    else:
+        paginated_ids, has_less, has_more = paginate_query(GlobalLinkQuery("best"), 20)
     links = Link.by_ids(paginated_ids)
+    Link.preload(links, user=current_user)
 
     return render_template(
         "index.html",
@@ -114,10 +122,11 @@ def best():
     )
 
 
+@cached_page(global_page)
 def trending():
-    links = trending_links(current_app.config["DEFAULT_FEEDS"])
-    paginated_ids, has_less, has_more = paginate(links, 20)
+    paginated_ids, has_less, has_more = paginate_query(GlobalLinkQuery("trending"), 20)
     links = Link.by_ids(paginated_ids)
+    Link.preload(links, user=current_user)
 
     return render_template(
         "index.html",
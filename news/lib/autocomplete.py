@@ -0,0 +1,150 @@
+import re
+
+from news.lib.cache import cache
+from news.lib.utils.time_utils import epoch_seconds
+
+# lengths of indexed prefixes of words
+MIN_PREFIX = 2
+MAX_PREFIX = 15
+
+# best results kept for each prefix
+RESULTS_PER_PREFIX = 10
+
+# link titles are completed only for recent links
+LINK_TTL = 7 * 24 * 60 * 60
+
+# members are "{slug}\t{name}" scored by subscribers
+FEED_KEY = "ac:f:{}"
+# members are "{id}\t{title}" scored by creation time
+LINK_KEY = "ac:l:{}"
+
+
+def _words(text: str) -> [str]:
+    return re.findall(r"\w+", (text or "").lower())
+
+
+def prefixes(text: str) -> {str}:
+    """
+    Indexed prefixes of all words of text
+    :param text: text
+    :return: prefixes
+    """
+    return {
+        word[:length]
+        for word in _words(text)
+        for length in range(MIN_PREFIX, min(len(word), MAX_PREFIX) + 1)
+    }
+
+
+def _index(pipe, key_format, member, score, text, ttl=None):
+    for prefix in prefixes(text):
+        key = key_format.format(prefix)
+        pipe.zadd(key, {member: score})
+        pipe.zremrangebyrank(key, 0, -RESULTS_PER_PREFIX - 1)
+        if ttl:
+            pipe.expire(key, ttl)
+
+
+def _feed_entry(slug: str, name: str) -> (str, str):
+    """
+    Member and indexed text of feed
+    """
+    return "{}\t{}".format(slug, name), "{} {}".format(name, slug)
+
+
+def add_feeds(feeds):
+    """
+    Add feeds to autocomplete index, feeds are completed by name and slug
+    Feeds already in the index get their score updated
+    :param feeds: feeds
+    """
+    pipe = cache.pipeline(transaction=False)
+    for feed in feeds:
+        member, text = _feed_entry(feed.slug, feed.name)
+        _index(pipe, FEED_KEY, member, feed.subscribers_count or 0, text)
+    pipe.execute()
+
+
+def remove_feed(slug: str, name: str):
+    """
+    Remove feed from autocomplete index
+    :param slug: indexed slug of the feed
+    :param name: indexed name of the feed
+    """
+    member, text = _feed_entry(slug, name)
+    pipe = cache.pipeline(transaction=False)
+    for prefix in prefixes(text):
+        pipe.zrem(FEED_KEY.format(prefix), member)
+    pipe.execute()
+
+
+def _link_entry(link) -> (str, str):
+    """
+    Member and indexed text of link
+    """
+    return "{}\t{}".format(link.id, link.title), link.title
+
+
+def add_links(links):
+    """
+    Add links to autocomplete index, links are completed by title
+    :param links: links
+    """
+    pipe = cache.pipeline(transaction=False)
+    for link in links:
+        member, text = _link_entry(link)
+        _index(pipe, LINK_KEY, member, epoch_seconds(link.created_at), text, LINK_TTL)
+    pipe.execute()
+
+
+def remove_link(link):
+    """
+    Remove link from autocomplete index
+    :param link: link
+    """
+    member, text = _link_entry(link)
+    pipe = cache.pipeline(transaction=False)
+    for prefix in prefixes(text):
+        pipe.zrem(LINK_KEY.format(prefix), member)
+    pipe.execute()
+
+
+def complete(q: str) -> ([dict], [dict]):
+    """
+    Complete feeds and link titles
+    The last word of the query is completed, the other words have to be present in the results
+    :param q: query
+    :return: feeds as {name, route}, links as {title, route}
+    """
+    words = _words(q)
+    if not words or len(words[-1]) < MIN_PREFIX:
+        return [], []
+    prefix = words[-1][:MAX_PREFIX]
+
+    pipe = cache.pipeline(transaction=False)
+    pipe.zrevrange(FEED_KEY.format(prefix), 0, -1)
+    pipe.zrevrange(LINK_KEY.format(prefix), 0, -1)
+    feeds, links = (
+        [member.decode().split("\t", 1) for member in members]
+        for members in pipe.execute()
+    )
+
+    def matches(text):
+        text_words = _words(text)
+        return all(
+            any(text_word.startswith(word) for text_word in text_words)
+            for word in words[:-1]
+        )
+
+    return (
+        [
+            {"name": name, "route": "/f/{}".format(slug)}
+            for slug, name in feeds
+            if matches("{} {}".format(name, slug))
+        ],
+        [
+            {"title": title, "route": "/l/{}".format(id)}
+            for id, title in links
+            if matches(title)
+        ],
+    )
@@ -1,18 +1,320 @@
+import os
+import struct
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta, timezone
 from pickle import loads, dumps
+from threading import Lock
+from time import monotonic
+from zlib import crc32
 
+import redis_lock
 from redis import StrictRedis
 
+from news.lib.metrics import LOCAL_CACHE_HITS, LOCAL_CACHE_MISSES
+
 DEFAULT_CACHE_TTL = 12 * 60 * 60  # 12 hours
 
+# pub/sub channel used to invalidate local caches of all processes
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+# invalidation message which clears whole local caches
+INVALIDATE_ALL = b"*"
+
+# seconds for which process_pending holds its lock without renewal, also the longest wait for it
+PENDING_LOCK_EXPIRE = 60
+
+# first byte of values written by pickle (protocol 2 and higher)
+PICKLE_VERSION = 0x80
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# packed schema version, whole crc32 of the fields so changed schemas practically never collide
+SCHEMA_VERSION = struct.Struct("<I")
+
+
+def _encode_int(value):
+    if type(value) is bool or not isinstance(value, int):
+        raise TypeError("int expected")
+    return value
+
+
+def _encode_float(value):
+    if type(value) is bool or not isinstance(value, (int, float)):
+        raise TypeError("float expected")
+    return value
+
+
+def _encode_bool(value):
+    if type(value) is not bool:
+        raise TypeError("bool expected")
+    return value
+
+
+def _encode_datetime(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // MICROSECOND
+
+
+# field type -> (struct format, encoder)
+FIELD_TYPES = {
+    "int": ("q", _encode_int),
+    "float": ("d", _encode_float),
+    "bool": ("?", _encode_bool),
+    "datetime": ("q", _encode_datetime),
+}
+
+_Layout = namedtuple(
+    "_Layout", ["fixed", "lengths", "fixed_names", "datetimes", "strings", "nulls"]
+)
+
+
+class CacheSchema:
+    """
+    Compact cached representation of model attributes
+
+    Fields are (name, type) pairs, type is one of int, float, bool, str or datetime.
+    Attributes outside of the schema aren't cached. Schema version is derived from the fields
+    so entries written with a different schema are treated as cache misses.
+    """
+
+    def __init__(self, *fields):
+        self.fields = fields
+        self.version = crc32(repr(fields).encode())
+        self._bitmap_size = (len(fields) + 7) // 8
+        self._layouts = {}
+
+    def _layout(self, present: int, valued: int) -> _Layout:
+        """
+        Get layout of packed attributes, layouts differ only by missing and null attributes
+        :param present: bitmap of present attributes
+        :param valued: bitmap of present attributes which aren't None
+        :return: layout
+        """
+        key = (present, valued)
+        if key not in self._layouts:
+            fmt, fixed_names, datetimes, strings, nulls = "<", [], [], [], []
+            for bit, (name, kind) in enumerate(self.fields):
+                if not present & (1 << bit):
+                    continue
+                if not valued & (1 << bit):
+                    nulls.append(name)
+                elif kind == "str":
+                    strings.append(name)
+                else:
+                    fmt += FIELD_TYPES[kind][0]
+                    fixed_names.append(name)
+                    if kind == "datetime":
+                        datetimes.append(name)
+            self._layouts[key] = _Layout(
+                struct.Struct(fmt),
+                struct.Struct("<{}I".format(len(strings))),
+                fixed_names,
+                datetimes,
+                strings,
+                nulls,
+            )
+        return self._layouts[key]
+
+    def pack(self, attributes: dict) -> bytes:
+        """
+        Pack attributes
+        Numbers are packed into single struct, strings are concatenated and prefixed by their lengths
+        :param attributes: attributes
+        :return: packed attributes without codec version
+        """
+        present = valued = 0
+        fixed, strings = [], []
+        for bit, (name, kind) in enumerate(self.fields):
+            if name not in attributes:
+                continue
+            present |= 1 << bit
+            value = attributes[name]
+            if value is None:
+                continue
+            valued |= 1 << bit
+            if kind == "str":
+                if not isinstance(value, str):
+                    raise TypeError("str expected")
+                strings.append(value)
+            else:
+                fixed.append(FIELD_TYPES[kind][1](value))
+
+        layout = self._layout(present, valued)
+        return b"".join(
+            (
+                SCHEMA_VERSION.pack(self.version),
+                present.to_bytes(self._bitmap_size, "little"),
+                valued.to_bytes(self._bitmap_size, "little"),
+                layout.fixed.pack(*fixed),
+                layout.lengths.pack(*[len(x) for x in strings]),
+                "".join(strings).encode(),
+            )
+        )
+
+    def unpack(self, data: bytes, offset: int) -> dict:
+        """
+        Unpack attributes
+        :param data: packed data
+        :param offset: offset of packed attributes in data
+        :return: attributes or None if the data were packed with different schema
+        """
+        if SCHEMA_VERSION.unpack_from(data, offset)[0] != self.version:
+            return None
+        size = self._bitmap_size
+        offset += SCHEMA_VERSION.size
+        present = int.from_bytes(data[offset : offset + size], "little")
+        valued = int.from_bytes(data[offset + size : offset + 2 * size], "little")
+        layout = self._layout(present, valued)
+        offset += 2 * size
+
+        attributes = dict(
+            zip(layout.fixed_names, layout.fixed.unpack_from(data, offset))
+        )
+        for name in layout.datetimes:
+            attributes[name] = EPOCH + timedelta(microseconds=attributes[name])
+        offset += layout.fixed.size
+
+        lengths = layout.lengths.unpack_from(data, offset)
+        text = data[offset + layout.lengths.size :].decode()
+        start = 0
+        for name, length in zip(layout.strings, lengths):
+            attributes[name] = text[start : start + length]
+            start += length
+
+        for name in layout.nulls:
+            attributes[name] = None
+        return attributes
+
+
+class PickleCodec:
+    """
+    Pickles everything, schemas are ignored
+    """
+
+    version = PICKLE_VERSION
+
+    def encode(self, value: object, schema: CacheSchema = None) -> bytes:
+        return dumps(value)
+
+    def decode(self, data: bytes, schema: CacheSchema = None) -> object:
+        return loads(data)
+
+
+class StructCodec:
+    """
+    Packs values with schema into struct prefixed with codec version, pickles other values
+    Values which don't match the schema fall back to pickle
+    """
+
+    version = 1
+
+    def encode(self, value: object, schema: CacheSchema = None) -> bytes:
+        if schema is None:
+            return dumps(value)
+        try:
+            return bytes((self.version,)) + schema.pack(value)
+        except (TypeError, ValueError, struct.error):
+            return dumps(value)
+
+    def decode(self, data: bytes, schema: CacheSchema = None) -> object:
+        if schema is None:
+            return None
+        return schema.unpack(data, 1)
+
+
+CODECS = {"pickle": PickleCodec(), "struct": StructCodec()}
+
+# codecs by first byte of encoded values, values written by any codec can be read
+# regardless of configured codec which allows switching codecs without flushing the cache
+CODEC_VERSIONS = {codec.version: codec for codec in CODECS.values()}
+
+
+def decode(data: bytes, schema: CacheSchema = None) -> object:
+    """
+    Decode value written by any codec
+    :param data: encoded value
+    :param schema: schema of the value
+    :return: value
+    """
+    codec = CODEC_VERSIONS.get(data[0])
+    if codec is None:
+        raise ValueError("Unknown cache codec version {}".format(data[0]))
+    return codec.decode(data, schema)
+
+
+class LocalCache:
+    """
+    Process local LRU cache with expiration of entries
+
+    Used in front of Redis for things which are read often and change rarely
+    """
+
+    def __init__(self, size: int, ttl: int):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str, raw: bool) -> (bool, object):
+        """
+        Get value from local cache
+        :param key: key
+        :param raw: whether raw value is requested
+        :return: (found, value)
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            expires, is_raw, value = entry
+            if expires < monotonic() or is_raw != raw:
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key: str, value: object, raw: bool):
+        """
+        Put value into local cache, evicts least recently used entry if the cache is full
+        :param key: key
+        :param value: value
+        :param raw: whether the value is raw or unpickled
+        """
+        with self._lock:
+            self._data[key] = (monotonic() + self.ttl, raw, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
 
 class Cache:
     """
     Cache serves as universal object for access to Redis
+
+    Keys with prefixes configured in LOCAL_CACHE are also cached in process local LRU caches,
+    writes and deletes of these keys are broadcasted through Redis pub/sub to invalidate local caches
+    of all processes. Local caches are short lived so missed invalidations resolve in at most ttl seconds.
     """
 
     def __init__(self, app=None):
         self.conn = None
         self._url = None
+        self._local = {}
+        self._listener = None
+        self._listener_pid = None
+        self.codec = CODECS["pickle"]
 
         if app is not None:
             self.init_app(app)
@@ -27,53 +329,174 @@ class Cache:
 
         self._url = app.config["REDIS_URL"]
         self.conn = StrictRedis.from_url(self._url)
+        self.codec = CODECS[app.config.get("CACHE_CODEC", "pickle")]
+
+        # prefix -> (size, ttl)
+        self._local = {
+            prefix: LocalCache(size, ttl)
+            for prefix, (size, ttl) in app.config.get("LOCAL_CACHE", {}).items()
+        }
+
+    def _local_cache(self, key: str, listen: bool = False):
+        """
+        Get local cache for given key
+        :param key: key
+        :param listen: make sure that this process listens to invalidations, reads have to do so
+        before anything gets cached locally, writes only publish invalidations
+        :return: local cache or None if the key isn't cached locally
+        """
+        if not self._local:
+            return None
+        if isinstance(key, bytes):
+            key = key.decode()
+        for prefix, local in self._local.items():
+            if key.startswith(prefix):
+                if listen:
+                    self._listen()
+                return local
+        return None
+
+    def _listen(self):
+        """
+        Start listening to invalidations in background thread
+        Thread is (re)started in every process because it doesn't survive fork
+        """
+        if self._listener_pid == os.getpid():
+            return
+        self._listener_pid = os.getpid()
+        for local in self._local.values():
+            local.clear()
+        pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: self._on_invalidation})
+        self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _on_invalidation(self, message):
+        key = message["data"]
+        if key == INVALIDATE_ALL:
+            for local in self._local.values():
+                local.clear()
+            return
+        local = self._local_cache(key)
+        if local is not None:
+            local.delete(key.decode())
+
+    def _invalidate(self, *keys):
+        """
+        Invalidate locally cached keys in all processes
+        :param keys: keys
+        """
+        for key in keys:
+            local = self._local_cache(key)
+            if local is not None:
+                local.delete(key)
+                self.conn.publish(INVALIDATION_CHANNEL, key)
 
-    def get(self, key: str, raw: bool = False) -> object:
+    def get(
+        self,
+        key: str,
+        raw: bool = False,
+        local: bool = True,
+        schema: CacheSchema = None,
+    ) -> object:
         """
         Get object from cache
+        :param key: key
+        :param raw: get object raw or decode it
+        :param local: allow reading from local cache, reads before modifications shouldn't use it
+        :param schema: schema of the object
         :rtype: object
         """
+        local_cache = self._local_cache(key, listen=True) if local else None
+        if local_cache is not None:
+            found, value = local_cache.get(key, raw)
+            if found:
+                LOCAL_CACHE_HITS.labels(key[: key.find(":") + 1]).inc()
+                return value
+            LOCAL_CACHE_MISSES.labels(key[: key.find(":") + 1]).inc()
+
         data = self.conn.get(key)
-        if raw:
-            return data
-        return loads(data) if data else None
+        value = data if raw else decode(data, schema) if data else None
+        if local_cache is not None and value is not None:
+            local_cache.set(key, value, raw)
+        return value
 
-    def mget(self, ids: [str], raw: bool = False) -> [object]:
+    def mget(
+        self, ids: [str], raw: bool = False, schema: CacheSchema = None
+    ) -> [object]:
         """
         Get multiple objects
         :param ids: ids to get
-        :param raw: get objects raw or pickle-load them
+        :param raw: get objects raw or decode them
+        :param schema: schema of the objects
         :return: objects
         """
         if not ids:
             return []
 
-        data = self.conn.mget(ids)
+        result = [None] * len(ids)
+        missing = []
+        for idx, key in enumerate(ids):
+            local_cache = self._local_cache(key, listen=True)
+            if local_cache is not None:
+                found, result[idx] = local_cache.get(key, raw)
+                prefix = key[: key.find(":") + 1]
+                if found:
+                    LOCAL_CACHE_HITS.labels(prefix).inc()
+                    continue
+                LOCAL_CACHE_MISSES.labels(prefix).inc()
+            missing.append(idx)
 
-        if raw:
-            return data
-        if data:
-            return [loads(x) if x else None for x in data]
-        return None
+        if not missing:
+            return result
+
+        data = self.conn.mget([ids[idx] for idx in missing])
+        for idx, x in zip(missing, data):
+            result[idx] = x if raw else decode(x, schema) if x else None
+            local_cache = self._local_cache(ids[idx])
+            if local_cache is not None and result[idx] is not None:
+                local_cache.set(ids[idx], result[idx], raw)
+        return result
 
     def set(
-        self, key: str, val: object, ttl: int = DEFAULT_CACHE_TTL, raw: bool = False
+        self,
+        key: str,
+        val: object,
+        ttl: int = DEFAULT_CACHE_TTL,
+        raw: bool = False,
+        schema: CacheSchema = None,
     ):
         """
         Put key-value pair into the cache
         :param key: key
         :param val: value
         :param ttl: time to live in seconds
-        :param raw: raw object or use pickle
+        :param raw: raw object or encode it with configured codec
+        :param schema: schema of the value
         :return:
         """
+        data = val if raw else self.codec.encode(val, schema)
         if ttl == 0:
-            return self.conn.set(key, val if raw else dumps(val))
+            res = self.conn.set(key, data)
         else:
-            return self.conn.setex(key, ttl, val if raw else dumps(val))
+            res = self.conn.setex(key, ttl, data)
+        self._invalidate(key)
+        return res
+
+    def delete(self, *keys):
+        """
+        Delete keys from cache
+        :param keys: keys
+        :return: number of deleted keys
+        """
+        res = self.conn.delete(*keys)
+        self._invalidate(*keys)
+        return res
 
     def clear(self):
-        return self.conn.flushdb()
+        res = self.conn.flushdb()
+        if self._local:
+            self.conn.publish(INVALIDATION_CHANNEL, INVALIDATE_ALL)
+        return res
 
     def __getattr__(self, name):
         return getattr(self.conn, name)
@@ -89,3 +512,101 @@ class Cache:
 
 
 cache = Cache()
+
+
+class LuaScript:
+    """
+    Lua script executed atomically in Redis
+
+    Scripts are registered lazily on first call because the cache connection
+    doesn't exist yet when modules defining the scripts are imported
+    """
+
+    def __init__(self, source: str):
+        self._source = source
+        self._script = None
+
+    def __call__(self, keys=(), args=(), client=None):
+        """
+        Run the script, uses EVALSHA and falls back to EVAL if the script isn't loaded
+        :param keys: keys accessed by the script
+        :param args: script arguments
+        :param client: optional client or pipeline to run the script with
+        :return: script result
+        """
+        if self._script is None:
+            self._script = cache.conn.register_script(self._source)
+        return self._script(keys=list(keys), args=list(args), client=client)
+
+
+# KEYS: pending keys, their processing keys
+# pending keys are moved only after their previous batch got processed
+# returns contents of processing keys
+HANDOFF_SCRIPT = LuaScript(
+    """
+local n = #KEYS / 2
+local result = {}
+for i = 1, n do
+    if redis.call("EXISTS", KEYS[i + n]) == 0 and redis.call("EXISTS", KEYS[i]) == 1 then
+        redis.call("RENAME", KEYS[i], KEYS[i + n])
+    end
+    local key, data = KEYS[i + n], {}
+    local type = redis.call("TYPE", key)["ok"]
+    if type == "list" then
+        data = redis.call("LRANGE", key, 0, -1)
+    elseif type == "hash" then
+        data = redis.call("HGETALL", key)
+    elseif type == "set" then
+        data = redis.call("SMEMBERS", key)
+    elseif type == "zset" then
+        data = redis.call("ZRANGE", key, 0, -1)
+    end
+    result[i] = data
+end
+return result
+"""
+)
+
+
+def processing_key(key: str) -> str:
+    """
+    Key holding data of pending key while they are being processed
+    :param key: pending key
+    :return: processing key
+    """
+    return key + ":processing"
+
+
+def process_pending(keys: [str], process) -> bool:
+    """
+    Process data accumulated in pending keys
+
+    Pending keys are moved to processing keys first and deleted only after they are processed,
+    data of failed run are processed by the next one before any newer data.
+    Runs are serialized by lock so concurrent runs never process the same data twice,
+    process still has to delete processing data which can't be processed twice as soon as
+    they are written so a failure of later step doesn't repeat them
+    :param keys: pending keys
+    :param process: called with contents of processing keys (list, hash as flat list, set or zset members)
+    :return: False if the lock couldn't be acquired
+    """
+    processing = [processing_key(key) for key in keys]
+    lock = redis_lock.Lock(
+        cache.conn,
+        "lock:{}".format(keys[0]),
+        expire=PENDING_LOCK_EXPIRE,
+        auto_renewal=True,
+    )
+    if not lock.acquire(timeout=PENDING_LOCK_EXPIRE):
+        return False
+    try:
+        # first round finishes previously failed run if there is any
+        for _ in range(2):
+            data = HANDOFF_SCRIPT(keys=keys + processing)
+            if not any(data):
+                break
+            process(*data)
+            cache.delete(*processing)
+    finally:
+        lock.release()
+    return True
@@ -1,3 +1,48 @@
+from flask import current_app
+
+from news.lib.cache import cache, DEFAULT_CACHE_TTL
+
+
+def comments_generation_key(link_id) -> str:
+    return "cgen:{}".format(link_id)
+
+
+def bump_comments_generation(link_id):
+    """
+    Bump comments generation of link
+    Rendered comments of previous generations aren't used anymore
+    :param link_id: link id
+    """
+    pipe = cache.pipeline(transaction=False)
+    pipe.incr(comments_generation_key(link_id))
+    pipe.expire(comments_generation_key(link_id), DEFAULT_CACHE_TTL)
+    pipe.execute()
+
+
+def cached_comments(link_id, variant: str, render) -> (str, [int]):
+    """
+    Get rendered comments of link from cache
+    Cached comments are versioned by comments generation of the link
+    :param link_id: link id
+    :param variant: variant of the rendered comments
+    :param render: renders the comments if they aren't cached, returns (html, [comment id])
+    :return: html, displayed comment ids
+    """
+    ttl = current_app.config["COMMENTS_CACHE_TTL"]
+    if ttl == 0:
+        return render()
+
+    generation = cache.get(comments_generation_key(link_id), raw=True) or b"0"
+    key = "cfrag:{}.{}:{}".format(link_id, variant, generation.decode())
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    rendered = render()
+    cache.set(key, rendered, ttl=ttl)
+    return rendered
+
+
 def add_new_comment(link_id, comment):
     """
     Adds new comment to given link
@@ -13,6 +58,7 @@ def add_new_comment(link_id, comment):
     # insert new comment into the comment tree of given link
     CommentTree(link_id).add([comment])
     SortedComments(link_id).update([comment])
+    bump_comments_generation(link_id)
 
 
 def update_comment(comment):
@@ -23,3 +69,4 @@ def update_comment(comment):
     from news.models.comment import SortedComments
 
     SortedComments(comment.link_id).update([comment])
+    bump_comments_generation(comment.link_id)
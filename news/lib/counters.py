@@ -0,0 +1,133 @@
+from news.lib.cache import cache, process_pending, processing_key
+
+# counter changes not written to database yet as {item cache key}:{attribute} -> change
+PENDING_COUNTERS_KEY = "counters:pending"
+# pending changes are moved here while being written to database
+PROCESSING_COUNTERS_KEY = processing_key(PENDING_COUNTERS_KEY)
+# incremented whenever written changes are removed from processing hash
+FLUSHES_KEY = "counters:flushes"
+
+
+class Counters:
+    """
+    Write-behind of model counters
+
+    With COUNTER_FLUSH_INTERVAL set counter changes are applied only to cached items and accumulated
+    in Redis hash, JOB_flush_counters then writes them with single UPDATE per table.
+    The job is enqueued periodically by clock process. Zero interval writes each change immediately.
+    """
+
+    def __init__(self, app=None):
+        self.flush_interval = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Init counters from config
+        :param app: application
+        """
+        self.flush_interval = app.config["COUNTER_FLUSH_INTERVAL"]
+
+    @property
+    def write_behind(self) -> bool:
+        return self.flush_interval > 0
+
+    @staticmethod
+    def field(item, attr: str) -> str:
+        """
+        Field of pending changes hash
+        :param item: item
+        :param attr: counter attribute
+        :return: field
+        """
+        return "{}:{}".format(item._cache_key, attr)
+
+    def add(self, item, attr: str, amp: int, pipe=None):
+        """
+        Add pending counter change
+        :param item: item
+        :param attr: counter attribute
+        :param amp: change
+        :param pipe: optional pipeline
+        """
+        (pipe or cache).hincrby(PENDING_COUNTERS_KEY, self.field(item, attr), amp)
+
+    @staticmethod
+    def flushes() -> int:
+        """
+        Number of flushes of written changes, has to be read before the item is loaded
+        from database and passed to pending
+        """
+        return int(cache.get(FLUSHES_KEY, raw=True, local=False) or 0)
+
+    def pending(self, item, attrs: [str], flushes: int) -> dict:
+        """
+        Get changes of item not written to database yet
+        Only the pending hash is read, changes are moved out of it before they are written to database
+        so they are never counted twice. Changes which were being flushed while the item was loaded
+        may or may not be in the loaded values, such items shouldn't be cached.
+        :param item: item loaded from database
+        :param attrs: counter attributes
+        :param flushes: flushes read before the item was loaded
+        :return: {attribute: change} or None if changes of the item were being flushed
+        """
+        fields = [self.field(item, attr) for attr in attrs]
+        pipe = cache.pipeline()
+        pipe.hmget(PENDING_COUNTERS_KEY, fields)
+        pipe.hmget(PROCESSING_COUNTERS_KEY, fields)
+        pipe.get(FLUSHES_KEY)
+        pending, processing, current = pipe.execute()
+        if any(processing) or int(current or 0) != flushes:
+            return None
+        return {attr: int(change or 0) for attr, change in zip(attrs, pending)}
+
+
+counters = Counters()
+
+
+def _models_by_prefix():
+    """
+    Get models by their cache prefixes, longest prefixes first
+    """
+    from news.models.base import Base
+
+    models, stack = {}, [Base]
+    while stack:
+        model = stack.pop()
+        stack.extend(model.__subclasses__())
+        if getattr(model, "__counters__", None):
+            models[model._cache_prefix()] = model
+    return sorted(models.items(), key=lambda x: -len(x[0]))
+
+
+def JOB_flush_counters():
+    """
+    Write pending counter changes to database
+    Changes are moved to processing hash first and deleted only after they are written,
+    changes of failed flush are written by the next one before any newer changes,
+    flushes are serialized by lock so overlapping runs never write the same changes twice
+    """
+    models = _models_by_prefix()
+
+    def flush(changes):
+        by_model = {}
+        for field, change in zip(changes[::2], changes[1::2]):
+            key, attr = field.decode().rsplit(":", 1)
+            for prefix, model in models:
+                if key.startswith(prefix):
+                    fields, deltas = by_model.setdefault(model, ([], {}))
+                    fields.append(field)
+                    deltas.setdefault(int(key[len(prefix) :]), {})[attr] = int(change)
+                    break
+
+        for model, (fields, deltas) in by_model.items():
+            model.update_counters(deltas)
+            # written changes mustn't be written again if update of another model fails
+            pipe = cache.pipeline()
+            pipe.hdel(PROCESSING_COUNTERS_KEY, *fields)
+            pipe.incr(FLUSHES_KEY)
+            pipe.execute()
+
+    process_pending([PENDING_COUNTERS_KEY], flush)
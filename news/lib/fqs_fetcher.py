@@ -0,0 +1,184 @@
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+from news.lib.metrics import FQS_FETCH_ERRORS, FQS_FETCH_TIME
+
+# maximal number of sources fetched at once
+FETCH_WORKERS = 16
+# maximal number of sources fetched at once from single host
+FETCH_PER_HOST = 2
+# seconds a whole fetch of source can take
+FETCH_TIMEOUT = 10
+# maximal size of fetched document
+FETCH_MAX_SIZE = 5 * 1024 * 1024
+
+USER_AGENT = "eSource News FQS importer"
+
+
+class FetchError(Exception):
+    pass
+
+
+class FetchResult:
+    """
+    Result of source fetch
+    """
+
+    def __init__(
+        self,
+        source,
+        data: bytes = None,
+        error: Exception = None,
+        elapsed=0.0,
+        not_modified=False,
+        etag: str = None,
+        last_modified: str = None,
+    ):
+        self.source = source
+        self.data = data
+        self.error = error
+        self.elapsed = elapsed
+        self.not_modified = not_modified
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+def _host(url: str) -> str:
+    return urlparse(url).hostname or ""
+
+
+def interleave_by_host(sources: list) -> list:
+    """
+    Order sources so sources of the same host are as far from each other as possible
+    Workers then rarely wait for the per host limit
+    :param sources: sources
+    :return: reordered sources
+    """
+    by_host = defaultdict(deque)
+    for source in sources:
+        by_host[_host(source.url)].append(source)
+    queues = sorted(by_host.values(), key=len, reverse=True)
+
+    result = []
+    while queues:
+        for queue in queues:
+            result.append(queue.popleft())
+        queues = [queue for queue in queues if queue]
+    return result
+
+
+class Fetcher:
+    """
+    Concurrent fetcher of Fully Qualified Sources
+
+    Sources are only downloaded by the worker threads, documents are parsed by the caller
+    as the fetches complete so slow parsing never holds a fetch slot
+    """
+
+    def __init__(
+        self,
+        workers=FETCH_WORKERS,
+        per_host=FETCH_PER_HOST,
+        timeout=FETCH_TIMEOUT,
+        max_size=FETCH_MAX_SIZE,
+    ):
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_size = max_size
+        self._hosts = {}
+        self._hosts_lock = Lock()
+
+    def _host_slot(self, host: str) -> BoundedSemaphore:
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    @staticmethod
+    def conditional_headers(source) -> dict:
+        """
+        Request headers validating document from the previous fetch of source
+        :param source: source
+        :return: headers
+        """
+        headers = {}
+        if getattr(source, "etag", None):
+            headers["If-None-Match"] = source.etag
+        if getattr(source, "last_modified", None):
+            headers["If-Modified-Since"] = source.last_modified
+        return headers
+
+    def download(self, url: str, deadline: float, headers: dict = None):
+        """
+        Download document
+        :param url: url
+        :param deadline: monotonic time when the download has to be finished
+        :param headers: additional request headers
+        :return: document and response headers, None document if not modified
+        """
+        request = Request(url, headers={"User-Agent": USER_AGENT, **(headers or {})})
+        try:
+            response = urlopen(request, timeout=max(deadline - monotonic(), 0.001))
+        except HTTPError as e:
+            if e.code == 304:
+                return None, e.headers
+            raise
+        with response:
+            chunks, size = [], 0
+            while True:
+                if monotonic() > deadline:
+                    raise FetchError("timeout")
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    return b"".join(chunks), response.headers
+                size += len(chunk)
+                if size > self.max_size:
+                    raise FetchError("document too large")
+                chunks.append(chunk)
+
+    def fetch(self, source) -> FetchResult:
+        """
+        Fetch single source, waits for free slot of the source host
+        Request is conditional if the source has validators from the previous fetch
+        :param source: source
+        :return: fetch result
+        """
+        with self._host_slot(_host(source.url)):
+            start = monotonic()
+            try:
+                data, headers = self.download(
+                    source.url, start + self.timeout, self.conditional_headers(source)
+                )
+                result = FetchResult(
+                    source,
+                    data=data,
+                    elapsed=monotonic() - start,
+                    not_modified=data is None,
+                    etag=headers.get("ETag"),
+                    last_modified=headers.get("Last-Modified"),
+                )
+            except Exception as e:
+                FQS_FETCH_ERRORS.labels(type(e).__name__).inc()
+                result = FetchResult(source, error=e, elapsed=monotonic() - start)
+        FQS_FETCH_TIME.observe(result.elapsed)
+        return result
+
+    def fetch_all(self, sources: list):
+        """
+        Fetch sources concurrently
+        :param sources: sources
+        :return: iterator of fetch results in order of completion
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                executor.submit(self.fetch, source)
+                for source in interleave_by_host(sources)
+            ]
+            for future in as_completed(futures):
+                yield future.result()
@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+
+from news.lib.cache import cache, LuaScript
+from news.lib.metrics import FQS_DISPATCH_LAG, FQS_DUE, FQS_SCHEDULE_LAG
+from news.lib.utils.time_utils import epoch_seconds
+
+# ids of Fully Qualified Sources scored by epoch seconds of their next update
+SCHEDULE_KEY = "fqs:schedule"
+# current update intervals of sources adapted to how often they change as id -> seconds
+INTERVALS_KEY = "fqs:intervals"
+
+# seconds for which popped source isn't popped again, source whose update got lost is retried after it
+LEASE = 10 * 60
+# adapted interval stays between base interval divided and multiplied by these factors
+MIN_INTERVAL_FACTOR = 4
+MAX_INTERVAL_FACTOR = 8
+# no source is updated more often than this
+MIN_INTERVAL = 60
+
+# KEYS: schedule
+# ARGV: now, batch size, lease
+# returns due ids with their scheduled times, popped sources are postponed by lease
+POP_DUE_SCRIPT = LuaScript(
+    """
+local due = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "WITHSCORES", "LIMIT", 0, ARGV[2])
+local leased_until = tonumber(ARGV[1]) + tonumber(ARGV[3])
+for i = 1, #due, 2 do
+    redis.call("ZADD", KEYS[1], leased_until, due[i])
+end
+return due
+"""
+)
+
+
+def _now() -> float:
+    # next updates are naive local datetimes, compare them with local time too
+    return epoch_seconds(datetime.now())
+
+
+def schedule(sources):
+    """
+    Schedule updates of sources at their next_update
+    :param sources: sources
+    """
+    if sources:
+        cache.zadd(
+            SCHEDULE_KEY,
+            {source.id: epoch_seconds(source.next_update) for source in sources},
+        )
+
+
+def unschedule(source_id):
+    """
+    Remove source from schedule
+    :param source_id: source id
+    """
+    pipe = cache.pipeline(transaction=False)
+    pipe.zrem(SCHEDULE_KEY, source_id)
+    pipe.hdel(INTERVALS_KEY, source_id)
+    pipe.execute()
+
+
+def sync_schedule():
+    """
+    Rebuild schedule from database
+    Database is the source of truth, this fixes sources added or removed behind schedulers back
+    """
+    from news.models.fully_qualified_source import FullyQualifiedSource
+
+    sources = FullyQualifiedSource.all()
+    ids = {source.id for source in sources}
+    scheduled = {int(id) for id in cache.zrange(SCHEDULE_KEY, 0, -1)}
+    pipe = cache.pipeline(transaction=False)
+    if scheduled - ids:
+        pipe.zrem(SCHEDULE_KEY, *(scheduled - ids))
+        pipe.hdel(INTERVALS_KEY, *(scheduled - ids))
+    pipe.execute()
+    # sources which are being updated keep their lease
+    schedule([source for source in sources if source.id not in scheduled])
+
+
+def pop_due(batch_size: int) -> [(int, float)]:
+    """
+    Pop sources whose update is due
+    Popped sources are leased so concurrent schedulers don't dispatch them twice
+    :param batch_size: maximal number of sources
+    :return: list of (source id, epoch seconds when the update was due)
+    """
+    now = _now()
+    due = POP_DUE_SCRIPT(keys=[SCHEDULE_KEY], args=[now, batch_size, LEASE])
+    popped = [(int(id), float(at)) for id, at in zip(due[::2], due[1::2])]
+    for _, at in popped:
+        FQS_DISPATCH_LAG.observe(max(now - at, 0))
+    return popped
+
+
+def next_interval(source, changed: bool, posted: int, failed: bool) -> timedelta:
+    """
+    Adapt update interval of source to how often it changes
+    Failing sources and sources without new articles back off, sources with new articles speed up,
+    interval stays within bounds given by update interval set by feed admin
+    :param source: source
+    :param changed: did the document change since the previous update
+    :param posted: number of newly posted links
+    :param failed: did the update fail
+    :return: interval until the next update
+    """
+    base = source.update_interval.total_seconds()
+    current = float(cache.hget(INTERVALS_KEY, source.id) or base)
+    if failed:
+        current *= 2
+    elif not changed or posted == 0:
+        current *= 1.5
+    else:
+        current /= 2
+    current = min(
+        max(current, base / MIN_INTERVAL_FACTOR, MIN_INTERVAL),
+        base * MAX_INTERVAL_FACTOR,
+    )
+    cache.hset(INTERVALS_KEY, source.id, current)
+    return timedelta(seconds=current)
+
+
+def _due():
+    """
+    Number of sources whose update is due
+    """
+    return cache.zcount(SCHEDULE_KEY, "-inf", _now())
+
+
+def _schedule_lag():
+    """
+    Seconds since update of the longest waiting source was due
+    """
+    first = cache.zrange(SCHEDULE_KEY, 0, 0, withscores=True)
+    return max(_now() - first[0][1], 0) if first else 0
+
+
+FQS_DUE.set_function(_due)
+FQS_SCHEDULE_LAG.set_function(_schedule_lag)
@@ -0,0 +1,220 @@
+from time import time
+
+from news.clients.db.query import LinkQuery
+from news.lib.cache import cache
+from news.lib.normalized_listing import merged_tuples
+
+HOME_SORTS = ["trending", "new", "best"]
+
+# sorted set of user ids with materialized home listing scored by time of last access
+ACTIVE_USERS_KEY = "home:active"
+
+
+class HomeListings:
+    """
+    Settings of materialized home listings
+
+    Home listing of logged in user is built on first request from listings of his subscribed feeds,
+    link updates of these feeds are then fanned out to it
+    Listings are dropped after HOME_LISTING_INACTIVITY seconds without access
+    and at most HOME_LISTING_MAX_USERS users keep their listings at once,
+    clock process drops them every HOME_LISTING_PRUNE_INTERVAL seconds
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.size = 300
+        self.max_users = 10000
+        self.inactivity = 6 * 60 * 60
+        self.prune_interval = 60
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Init home listings from config
+        :param app: application
+        """
+        self.enabled = app.config["HOME_LISTINGS"]
+        self.size = app.config["HOME_LISTING_SIZE"]
+        self.max_users = app.config["HOME_LISTING_MAX_USERS"]
+        self.inactivity = app.config["HOME_LISTING_INACTIVITY"]
+        self.prune_interval = app.config["HOME_LISTING_PRUNE_INTERVAL"]
+
+
+home_listings = HomeListings()
+
+
+def _feed_users_key(feed_id):
+    """
+    Key of set of users with materialized home listing subscribed to given feed
+    """
+    return "home:fu:{}".format(feed_id)
+
+
+def _user_feeds_key(user_id):
+    """
+    Key of set of feeds whose links are materialized in home listing of given user
+    """
+    return "home:uf:{}".format(user_id)
+
+
+class HomeLinkQuery(LinkQuery):
+    """
+    Materialized listing of links from feeds subscribed by the user
+    """
+
+    def __init__(self, user_id, sort, feed_ids=None, storage=None):
+        super().__init__("home{}".format(user_id), sort, storage=storage)
+        self.user_id = user_id
+        self.feed_ids = feed_ids
+
+    def __repr__(self):
+        return "<HomeQuery %s %s>" % (self.user_id, self.sort)
+
+    @property
+    def _page_scope(self):
+        # home listings are shown only to logged in users whose pages aren't cached
+        return None
+
+    @property
+    def limit(self):
+        return home_listings.size
+
+    @property
+    def ttl(self):
+        return home_listings.inactivity
+
+    def _rebuild(self):
+        """
+        Rebuild home listing by merging listings of subscribed feeds
+        User is registered for updates before the merge so no update gets lost
+        :return: rebuilt list of [id, sort value...] tuples
+        """
+        assert self.feed_ids is not None
+
+        pipe = cache.pipeline()
+        pipe.delete(_user_feeds_key(self.user_id))
+        if self.feed_ids:
+            pipe.sadd(_user_feeds_key(self.user_id), *self.feed_ids)
+        for feed_id in self.feed_ids:
+            pipe.sadd(_feed_users_key(feed_id), self.user_id)
+        pipe.execute()
+
+        self._data = merged_tuples(self.feed_ids, self.sort, self.limit)
+        self._fetched = True
+        self._save()
+        return self._data
+
+    def fetch(self, start=0, stop=None):
+        cache.zadd(ACTIVE_USERS_KEY, {self.user_id: time()})
+        return super().fetch(start, stop)
+
+
+def home_query(user, sort):
+    """
+    Get home listing of given user
+    :param user: logged in user
+    :param sort: sort
+    :return: home link query
+    """
+    return HomeLinkQuery(user.id, sort, feed_ids=user.subscribed_feed_ids)
+
+
+def home_listing_updates(links, sorts):
+    """
+    Get updates of home listings of users subscribed to feeds of given links
+    :param links: updated links
+    :param sorts: sorts to update
+    :return: list of (home link query, links) for LinkQuery.insert_batch
+    """
+    if not home_listings.enabled or not links:
+        return []
+
+    feed_ids = list({link.feed_id for link in links})
+    pipe = cache.pipeline(transaction=False)
+    for feed_id in feed_ids:
+        pipe.smembers(_feed_users_key(feed_id))
+    users = dict(zip(feed_ids, pipe.execute()))
+
+    return [
+        (HomeLinkQuery(int(uid), sort), [link])
+        for link in links
+        for uid in users[link.feed_id]
+        for sort in sorts
+    ]
+
+
+def update_home_listings(link, sorts):
+    """
+    Fan-out link update to home listings of users subscribed to links feed
+    :param link: updated link
+    :param sorts: sorts to update
+    """
+    LinkQuery.insert_batch(home_listing_updates([link], sorts))
+
+
+def remove_from_home_listings(link, sorts):
+    """
+    Remove link from home listings of users subscribed to links feed
+    :param link: removed link
+    :param sorts: sorts to update
+    """
+    for uid in cache.smembers(_feed_users_key(link.feed_id)):
+        for sort in sorts:
+            HomeLinkQuery(int(uid), sort).delete([link])
+
+
+def drop_home_listing(user_id):
+    """
+    Drop materialized home listings of given user
+    Listings are rebuilt on next request, used when users subscriptions change
+    :param user_id: user id
+    """
+    if home_listings.enabled:
+        drop_home_listings([user_id])
+
+
+def drop_home_listings(user_ids):
+    """
+    Drop materialized home listings of given users
+    :param user_ids: user ids
+    """
+    if not user_ids:
+        return
+
+    pipe = cache.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.smembers(_user_feeds_key(user_id))
+    feeds = pipe.execute()
+
+    pipe = cache.pipeline()
+    for user_id, feed_ids in zip(user_ids, feeds):
+        for feed_id in feed_ids:
+            pipe.srem(_feed_users_key(int(feed_id)), user_id)
+        pipe.delete(_user_feeds_key(user_id))
+        for sort in HOME_SORTS:
+            pipe.delete(HomeLinkQuery(user_id, sort)._cache_key)
+    pipe.zrem(ACTIVE_USERS_KEY, *user_ids)
+    pipe.execute()
+
+
+def drop_inactive_listings():
+    """
+    Drop home listings of users who didn't access them for a while
+    and of least recently active users over the limit
+    Enqueued periodically by clock process
+    """
+    pipe = cache.pipeline(transaction=False)
+    pipe.zrangebyscore(ACTIVE_USERS_KEY, "-inf", time() - home_listings.inactivity)
+    pipe.zcard(ACTIVE_USERS_KEY)
+    inactive, active_count = pipe.execute()
+
+    over_limit = active_count - len(inactive) - home_listings.max_users
+    if over_limit > 0:
+        inactive += cache.zrange(
+            ACTIVE_USERS_KEY, len(inactive), len(inactive) + over_limit - 1
+        )
+
+    drop_home_listings([int(x) for x in inactive])
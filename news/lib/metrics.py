@@ -4,5 +4,42 @@ from prometheus_client import Summary, Counter, Gauge, Histogram
 CACHE_HITS = Counter("cache_hits_total", "Total cache hits")
 CACHE_MISSES = Counter("cache_miss_total", "Total cache misses")
 RATELIMIT_HITS = Counter("ratelimit_hits", "Total hits of ratelimit")
+RATELIMIT_LOCAL_HITS = Counter(
+    "ratelimit_local_hits", "Total hits of ratelimit rejected without asking Redis"
+)
 QUEUE_STATE = Gauge("tasks_in_queue", "Total tasks in queue")
 REQUEST_TIME = Histogram("request_processing_seconds", "Time spent processing request")
+LOCAL_CACHE_HITS = Counter(
+    "local_cache_hits_total", "Total process local cache hits", ["prefix"]
+)
+LOCAL_CACHE_MISSES = Counter(
+    "local_cache_miss_total", "Total process local cache misses", ["prefix"]
+)
+RERANK_PENDING = Gauge("rerank_pending_links", "Links waiting for re-ranking")
+RERANK_LAG = Gauge(
+    "rerank_lag_seconds", "Time the longest waiting link waits for re-ranking"
+)
+PAGE_CACHE_HITS = Counter("page_cache_hits_total", "Total hits of anonymous page cache")
+PAGE_CACHE_MISSES = Counter(
+    "page_cache_miss_total", "Total misses of anonymous page cache"
+)
+FQS_FETCH_TIME = Histogram(
+    "fqs_fetch_seconds", "Time spent fetching Fully Qualified Sources"
+)
+FQS_FETCH_ERRORS = Counter(
+    "fqs_fetch_errors_total", "Failed fetches of Fully Qualified Sources", ["error"]
+)
+FQS_UNCHANGED = Counter(
+    "fqs_unchanged_total",
+    "Fetches of Fully Qualified Sources skipped as unchanged",
+    ["reason"],
+)
+FQS_DUE = Gauge("fqs_due_sources", "Fully Qualified Sources whose update is due")
+FQS_SCHEDULE_LAG = Gauge(
+    "fqs_schedule_lag_seconds",
+    "Time since update of the longest waiting Fully Qualified Source was due",
+)
+FQS_DISPATCH_LAG = Histogram(
+    "fqs_dispatch_lag_seconds",
+    "Delay between scheduled and dispatched update of Fully Qualified Source",
+)
@@ -8,41 +8,47 @@ from news.lib.utils.time_utils import epoch_seconds
 MAX_LINKS = 1000
 
 
-# returns links as tuples so they can be effectively merged/sorted with heapq
-def trending_tuples(fid):
-    query = LinkQuery(fid, "trending")
-    return [(-hot_score, link) for link, hot_score in query.fetch()]
-
-
-def trending_links(ids):
-    links_by_fids = {}
+def merged_tuples(ids, sort, limit=MAX_LINKS, time_filter=None):
+    """
+    Merge sorted link tuples of multiple feeds
+    Listings of all feeds are fetched in one batch and merged lazily, merging stops after limit links
+    :param ids: feed ids
+    :param sort: sort
+    :param limit: maximal number of links to return
+    :param time_filter: filter of link creation time, only for best
+    :return: sorted list of [id, sort values...] tuples
+    """
+    limit = min(limit, MAX_LINKS)
+    queries = [LinkQuery(fid, sort) for fid in ids]
 
-    # get sorted links for individual feeds
-    for fid in ids:
-        links_by_fids[fid] = trending_tuples(fid)
+    # no feed can contribute more than limit links unless some of them get filtered out
+    listings = LinkQuery.fetch_many(queries, stop=None if time_filter else limit)
+    if time_filter is not None:
+        listings = [(x for x in listing if time_filter(x[2])) for listing in listings]
 
-    # merge already sorted arrays of links of individual feeds
-    merged = heapq.merge(*links_by_fids.values())
-    ret = list(itertools.islice((link for _, link in merged), MAX_LINKS))
-    return ret
+    # listings of individual feeds are already sorted by sort values
+    merged = heapq.merge(*listings, key=lambda x: x[1:], reverse=True)
+    return list(itertools.islice(merged, limit))
 
 
-def new_tuples(fid):
-    query = LinkQuery(fid, "new")
-    return [(-time, link) for link, time in query.fetch()]
+def merged_links(ids, sort, limit=MAX_LINKS, time_filter=None):
+    """
+    Merge sorted links of multiple feeds
+    :param ids: feed ids
+    :param sort: sort
+    :param limit: maximal number of links to return
+    :param time_filter: filter of link creation time, only for best
+    :return: sorted link ids
+    """
+    return [x[0] for x in merged_tuples(ids, sort, limit, time_filter)]
 
 
-def new_links(ids):
-    links_by_fids = {}
+def trending_links(ids, limit=MAX_LINKS):
+    return merged_links(ids, "trending", limit)
 
-    # get sorted links for individual feeds
-    for fid in ids:
-        links_by_fids[fid] = new_tuples(fid)
 
-    # merge already sorted arrays of links of individual feeds
-    merged = heapq.merge(*links_by_fids.values())
-    ret = list(itertools.islice((link for _, link in merged), MAX_LINKS))
-    return ret
+def new_links(ids, limit=MAX_LINKS):
+    return merged_links(ids, "new", limit)
 
 
 def get_time_filter(cutoff):
@@ -62,28 +68,13 @@ def get_time_filter(cutoff):
     return time_filters[cutoff]
 
 
-# returns links as tuples so they can be effectively merged/sorted with heapq
-def best_tuples(fid, time_filter):
-    query = LinkQuery(fid, "best", time=time_filter)
-    return [
-        (-score, link_id) for link_id, score, time in query.fetch() if time_filter(time)
-    ]
-
-
-def best_links(ids, time_limit="all"):
+def best_links(ids, time_limit="all", limit=MAX_LINKS):
     """
     Find best links by specified feed ids
     :param ids: feed ids
     :param time_limit: time limitation
+    :param limit: maximal number of links to return
     :return: sorted link ids
     """
-    links_by_fids = {}
-
-    # get sorted links for individual feeds
-    for fid in ids:
-        links_by_fids[fid] = best_tuples(fid, get_time_filter(time_limit))
-
-    # merge already sorted arrays of links of individual feeds
-    merged = heapq.merge(*links_by_fids.values())
-    ret = list(itertools.islice((link for _, link in merged), MAX_LINKS))
-    return ret
+    time_filter = get_time_filter(time_limit) if time_limit != "all" else None
+    return merged_links(ids, "best", limit, time_filter)
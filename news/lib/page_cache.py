@@ -0,0 +1,96 @@
+from functools import update_wrapper
+from hashlib import md5
+from time import time
+
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+
+from news.lib.cache import cache, DEFAULT_CACHE_TTL
+from news.lib.comments import comments_generation_key
+from news.lib.metrics import PAGE_CACHE_HITS, PAGE_CACHE_MISSES
+
+
+def page_generation_key(scope) -> str:
+    """
+    Key of generation of pages showing given listings
+    :param scope: feed id or "global" for global listings
+    :return: redis key
+    """
+    return "pgen:{}".format(scope)
+
+
+def bump_page_generations(scopes):
+    """
+    Bump generations of pages showing given listings
+    Cached pages of previous generations aren't used anymore
+    :param scopes: feed ids or "global" for global listings, None scopes are skipped
+    """
+    pipe = cache.pipeline(transaction=False)
+    for scope in set(scopes) - {None}:
+        pipe.incr(page_generation_key(scope))
+        pipe.expire(page_generation_key(scope), DEFAULT_CACHE_TTL)
+    pipe.execute()
+
+
+def global_page(**kwargs) -> [str]:
+    return [page_generation_key("global")]
+
+
+def feed_page(feed, **kwargs) -> [str]:
+    return [page_generation_key(feed.id)]
+
+
+def link_page(link, **kwargs) -> [str]:
+    return [page_generation_key(link.feed_id), comments_generation_key(link.id)]
+
+
+def cached_page(generation_keys):
+    """
+    Cache of whole pages for anonymous users
+    Pages are cached by path and query for PAGE_CACHE_TTL seconds and versioned by generations
+    of the data they show, responses carry ETag and Last-Modified for conditional requests
+    :param generation_keys: function returning keys of generations of the page from view arguments
+    :return: wrapped view with page cache
+    """
+
+    def decorator(f):
+        def cached(*args, **kwargs):
+            ttl = current_app.config["PAGE_CACHE_TTL"]
+            if (
+                ttl == 0
+                or request.method != "GET"
+                or current_user.is_authenticated
+                or "_flashes" in session
+            ):
+                return f(*args, **kwargs)
+
+            generations = cache.mget(generation_keys(*args, **kwargs), raw=True)
+            key = "page:{}:{}".format(
+                ".".join((x or b"0").decode() for x in generations), request.full_path
+            )
+            page = cache.get(key)
+            if page is not None:
+                PAGE_CACHE_HITS.inc(1)
+                etag, last_modified, mimetype, body = page
+            else:
+                PAGE_CACHE_MISSES.inc(1)
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                etag, last_modified = md5(body).hexdigest(), int(time())
+                mimetype = response.mimetype
+                cache.set(key, (etag, last_modified, mimetype, body), ttl=ttl)
+
+            response = current_app.response_class(body, mimetype=mimetype)
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # clients revalidate so they don't keep the anonymous page after login
+            response.cache_control.public = True
+            response.cache_control.no_cache = True
+            response.vary.add("Cookie")
+            return response.make_conditional(request)
+
+        return update_wrapper(cached, f)
+
+    return decorator
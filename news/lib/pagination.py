@@ -10,3 +10,29 @@ def paginate(items, page_size):
         max(0, start - page_size) if start > 0 else None,
         end if end < len(items) else None,
     )
+
+
+def page_limit(page_size):
+    """
+    Number of items needed to render current page and to know if there is a next one
+    :param page_size: page size
+    :return: number of items
+    """
+    return max(request.args.get("count", default=0, type=int), 0) + page_size + 1
+
+
+def paginate_query(query, page_size):
+    """
+    Paginate link query
+    Fetches only ids of the requested page instead of the whole query
+    :param query: link query
+    :param page_size: page size
+    :return: ids, previous page start, next page start
+    """
+    count = max(request.args.get("count", default=0, type=int), 0)
+    ids = query.fetch_ids(count, count + page_size + 1)
+    return (
+        ids[:page_size],
+        max(0, count - page_size) if count > 0 else None,
+        count + page_size if len(ids) > page_size else None,
+    )
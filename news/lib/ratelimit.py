@@ -1,52 +1,239 @@
+from collections import namedtuple, OrderedDict
 from functools import update_wrapper
+from math import ceil
+from threading import Lock
+from time import monotonic, time
 
-from flask import request
+from flask import make_response, request
 from flask_login import current_user
-from werkzeug.exceptions import abort
+from werkzeug.exceptions import abort, TooManyRequests
+
+from news.lib.cache import LuaScript
+from news.lib.metrics import RATELIMIT_HITS, RATELIMIT_LOCAL_HITS
+
+# Generic cell rate algorithm, every key stores theoretical arrival time (TAT) in milliseconds
+# limit requests can be made at once, then one every seconds / limit as the quota refills
+# request is allowed only if all keys allow it and only then it consumes quota of all the keys
+# KEYS: limit keys
+# ARGV: now in milliseconds, limit, period in milliseconds
+# returns allowed (1/0), remaining requests, milliseconds until retry, milliseconds until full quota
+LIMIT_SCRIPT = LuaScript(
+    """
+local now = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local period = tonumber(ARGV[3])
+local interval = period / limit
+
+local allowed, remaining, retry_after, reset = 1, limit, 0, 0
+local tats = {}
+for i, key in ipairs(KEYS) do
+    local tat = math.max(tonumber(redis.call("GET", key)) or now, now) + interval
+    local allow_at = tat - period
+    if allow_at > now then
+        allowed = 0
+        retry_after = math.max(retry_after, allow_at - now)
+        tat = tat - interval
+    end
+    tats[i] = tat
+    remaining = math.min(remaining, math.floor((period - (tat - now)) / interval))
+    reset = math.max(reset, tat - now)
+end
+
+if allowed == 1 then
+    for i, key in ipairs(KEYS) do
+        redis.call("SET", key, tats[i], "PX", math.ceil(tats[i] - now))
+    end
+end
+return {allowed, remaining, math.ceil(retry_after), math.ceil(reset)}
+"""
+)
+
+RateLimit = namedtuple(
+    "RateLimit", ["allowed", "limit", "remaining", "retry_after", "reset"]
+)
+
+
+class LocalLimits:
+    """
+    Process local token buckets in front of Redis limits
+
+    Bucket has the same capacity and refill rate as the limit in Redis but sees only requests
+    of this process, so once it is empty the limit is surely exceeded in Redis too and the request
+    is rejected without asking Redis. Requests rejected by Redis block their keys locally until
+    they could be retried. Buckets are kept in bounded LRU so floods from many clients can't exhaust memory.
+    """
+
+    def __init__(self, app=None):
+        self.size = 0
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Init local limits from config
+        :param app: application
+        """
+        self.size = app.config["RATE_LIMIT_LOCAL_SIZE"]
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def check(self, keys: [str], limit: int, seconds: int):
+        """
+        Take token from bucket of given keys
+        :param keys: limit keys
+        :param limit: number of requests
+        :param seconds: timespan in seconds
+        :return: rate limit state if request is surely limited, None if Redis has to be asked
+        """
+        now = monotonic()
+        bucket = tuple(keys)
+        with self._lock:
+            if bucket not in self._buckets:
+                self._buckets[bucket] = [limit, now, now]
+                while len(self._buckets) > self.size:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(bucket)
+            entry = self._buckets[bucket]
+
+            # [tokens, last refill, blocked until]
+            tokens = min(limit, entry[0] + (now - entry[1]) * limit / seconds)
+            entry[0], entry[1] = tokens, now
+            if entry[2] > now:
+                retry_after = entry[2] - now
+            elif tokens < 1:
+                retry_after = (1 - tokens) * seconds / limit
+            else:
+                entry[0] -= 1
+                return None
+        return RateLimit(
+            False,
+            limit,
+            0,
+            ceil(retry_after),
+            ceil((limit - tokens) * seconds / limit),
+        )
+
+    def block(self, keys: [str], retry_after: int):
+        """
+        Block keys rejected by Redis until the request can be retried
+        Token taken by the rejected request is returned as Redis didn't consume quota
+        :param keys: limit keys
+        :param retry_after: seconds until retry
+        """
+        with self._lock:
+            entry = self._buckets.get(tuple(keys))
+            if entry is not None:
+                entry[0] += 1
+                entry[2] = monotonic() + retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+local_limits = LocalLimits()
+
+
+def _limit_keys(prefix, limit_user, limit_ip, key_func) -> [str]:
+    """
+    Keys limiting current request
+    """
+    to_limit = []
+    if limit_ip:
+        to_limit.append("rl:{}@{}".format(prefix, request.remote_addr or "127.0.0.1"))
+    if limit_user and current_user.is_authenticated:
+        to_limit.append("rl:{}.{}".format(prefix, current_user.username))
+    if key_func is not None:
+        to_limit.append("rl:{}_{}".format(prefix, key_func))
+    return to_limit
+
+
+def check_rate_limit(keys: [str], limit: int, seconds: int) -> RateLimit:
+    """
+    Check and consume quota of all given keys with single script call
+    :param keys: limit keys
+    :param limit: number of requests
+    :param seconds: timespan in seconds
+    :return: rate limit state, retry after and reset are in seconds
+    """
+    if not keys:
+        return RateLimit(True, limit, limit, 0, 0)
+    allowed, remaining, retry_after, reset = LIMIT_SCRIPT(
+        keys=keys, args=[int(time() * 1000), limit, seconds * 1000]
+    )
+    return RateLimit(
+        allowed == 1,
+        limit,
+        max(remaining, 0),
+        ceil(retry_after / 1000),
+        ceil(reset / 1000),
+    )
+
+
+def _check(keys: [str], limit: int, seconds: int, local: bool) -> RateLimit:
+    """
+    Check limit in local buckets first if enabled, then in Redis
+    """
+    if not local or not local_limits.enabled or not keys:
+        return check_rate_limit(keys, limit, seconds)
+
+    state = local_limits.check(keys, limit, seconds)
+    if state is not None:
+        RATELIMIT_LOCAL_HITS.inc(1)
+        return state
+    state = check_rate_limit(keys, limit, seconds)
+    if not state.allowed:
+        local_limits.block(keys, state.retry_after)
+    return state
+
 
-from news.lib.cache import cache
-from news.lib.metrics import RATELIMIT_HITS
+def _set_headers(response, state: RateLimit):
+    response.headers["X-RateLimit-Limit"] = str(state.limit)
+    response.headers["X-RateLimit-Remaining"] = str(state.remaining)
+    response.headers["X-RateLimit-Reset"] = str(state.reset)
+    if not state.allowed:
+        response.headers["Retry-After"] = str(state.retry_after)
+    return response
 
 
-def rate_limit(prefix, limit, seconds, limit_user=True, limit_ip=True, key_func=None):
+def _abort_limited(state: RateLimit):
+    RATELIMIT_HITS.inc(1)
+    abort(_set_headers(TooManyRequests().get_response(), state))
+
+
+def rate_limit(
+    prefix, limit, seconds, limit_user=True, limit_ip=True, key_func=None, local=False,
+):
     """
     Ratelimiting middleware
+    Responses carry X-RateLimit-* headers, limited requests get 429 with Retry-After
     :param prefix: ratelimiting prefix to use in redis
     :param limit: number of requests
     :param seconds: timespan in seconds
     :param limit_user: limit by user if user is logged in
     :param limit_ip: limit by ip
     :param key_func: custom key func
+    :param local: reject clients over the limit in process local buckets without asking Redis
     :return: wrapped function with ratelimiting
     """
 
     def decorator(f):
         def rate_limited(*args, **kwargs):
-            # construct keys
-            to_limit = []
-            if limit_ip:
-                to_limit.append(
-                    "rl:{}@{}".format(prefix, request.remote_addr or "127.0.0.1")
-                )
-            if limit_user and current_user.is_authenticated:
-                to_limit.append("rl:{}.{}".format(prefix, current_user.username))
-            if key_func is not None:
-                to_limit.append("rl:{}_{}".format(prefix, key_func))
-
-            # check limits
-            for limit_key in to_limit:
-                val = cache.incr(limit_key)
-
-                # limit is new or expired before
-                if val == 1:
-                    cache.expire(limit_key, seconds)
-
-                # limit surpassed
-                elif val > limit:
-                    RATELIMIT_HITS.inc(1)
-                    abort(429)
-
-            return f(*args, **kwargs)
+            state = _check(
+                _limit_keys(prefix, limit_user, limit_ip, key_func),
+                limit,
+                seconds,
+                local,
+            )
+            if not state.allowed:
+                _abort_limited(state)
+
+            return _set_headers(make_response(f(*args, **kwargs)), state)
 
         return update_wrapper(rate_limited, f)
 
@@ -54,28 +241,12 @@ def rate_limit(prefix, limit, seconds, limit_user=True, limit_ip=True, key_func=
 
 
 def rate_limit_ok(
-    prefix, limit, seconds, limit_user=True, limit_ip=True, key_func=None
+    prefix, limit, seconds, limit_user=True, limit_ip=True, key_func=None, local=False
 ):
-    # construct keys
-    to_limit = []
-    if limit_ip:
-        to_limit.append("rl:{}@{}".format(prefix, request.remote_addr or "127.0.0.1"))
-    if limit_user and current_user.is_authenticated:
-        to_limit.append("rl:{}.{}".format(prefix, current_user.username))
-    if key_func is not None:
-        to_limit.append("rl:{}_{}".format(prefix, key_func))
-
-    # check limits
-    for limit_key in to_limit:
-        val = cache.incr(limit_key)
-
-        # limit is new or expired before
-        if val == 1:
-            cache.expire(limit_key, seconds)
-
-        # limit surpassed
-        elif val > limit:
-            RATELIMIT_HITS.inc(1)
-            abort(429)
+    state = _check(
+        _limit_keys(prefix, limit_user, limit_ip, key_func), limit, seconds, local
+    )
+    if not state.allowed:
+        _abort_limited(state)
 
     return True
@@ -1,8 +1,20 @@
+from hashlib import md5
+from time import time
+
 from feedgen.entry import FeedEntry
 from feedgen.feed import FeedGenerator
+from flask import current_app, request
+
+from news.lib.cache import cache
+from news.models.link import Link
+
+# cached documents are keyed by the listed links so they don't need invalidation
+RSS_CACHE_TTL = 60 * 60
 
 
 def rss_entries(links, feed=None):
+    Link.preload(links, relations=("user",) if feed else ("feed", "user"))
+
     entries = []
     for link in links:
         fe = FeedEntry()
@@ -31,8 +43,50 @@ def rss_feed_builder(feed):
     return fg
 
 
+def rss_index_builder():
+    # TODO maybe do through fake feed (that's what reddit does and it actually makes sense)
+    fg = FeedGenerator()
+    fg.id("https://localhost:5000/")
+    fg.title("Newsfeed")
+    fg.link(href="http://localhost:5000/", rel="self")
+    fg.description("Global news agrregator!")
+    fg.language("en")
+    return fg
+
+
 def rss_page(feed, links):
-    fg = rss_feed_builder(feed)
-    for entry in rss_entries(links):
+    fg = rss_feed_builder(feed) if feed else rss_index_builder()
+    for entry in rss_entries(links, feed):
         fg.add_entry(entry)
     return fg.rss_str(pretty=True)
+
+
+def rss_response(feed, ids, public=True):
+    """
+    Cached RSS document of given links
+    The document is generated only when the listed links change, responses carry ETag
+    and Last-Modified so polling clients get 304 until then
+    :param feed: feed, None for the front page
+    :param ids: ids of listed links
+    :param public: can the document be stored by shared caches
+    :return: response
+    """
+    etag = md5(",".join(str(id) for id in ids).encode()).hexdigest()
+    cache_key = "rss:{}:{}".format(feed.id if feed else "index", etag)
+
+    document = cache.get(cache_key)
+    if document is None:
+        links = Link.by_ids(ids) if ids else []
+        document = (int(time()), rss_page(feed, links))
+        cache.set(cache_key, document, ttl=RSS_CACHE_TTL)
+    last_modified, body = document
+
+    response = current_app.response_class(body, mimetype="application/rss+xml")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
@@ -1,8 +1,84 @@
+from time import time
+
 from rq.decorators import job
 
-from news.clients.db.query import LinkQuery
-from news.lib.task_queue import redis_conn
-from news.scripts.import_fqs import import_fqs
+from news.clients.db.query import LinkQuery, GlobalLinkQuery
+from news.lib.cache import cache, process_pending, processing_key
+from news.lib.fqs_scheduler import unschedule
+from news.lib.home_listing import home_listing_updates
+from news.lib.metrics import RERANK_LAG, RERANK_PENDING
+from news.lib.task_queue import q, redis_conn
+from news.scripts.import_fqs import import_fqs, update_sources
+
+RERANK_SORTS = [
+    "trending",
+    "best",
+]  # no need to update 'new' because it doesn't depend on score
+
+# ids of links waiting for re-ranking scored by time when they were first marked
+RERANK_PENDING_KEY = "rerank:pending"
+# pending links are moved here while being re-ranked
+RERANK_PROCESSING_KEY = processing_key(RERANK_PENDING_KEY)
+# set while JOB_update_links is enqueued
+RERANK_SCHEDULED_KEY = "rerank:scheduled"
+# seconds after which re-ranking is enqueued again if the enqueued job got lost
+RERANK_SCHEDULED_TTL = 60
+
+
+def schedule_link_updates(link_ids):
+    """
+    Mark links for re-ranking
+    Links marked multiple times before the re-ranking are re-ranked only once
+    :param link_ids: link ids
+    """
+    if not link_ids:
+        return
+    pipe = cache.pipeline(transaction=False)
+    pipe.zadd(RERANK_PENDING_KEY, {id: time() for id in link_ids}, nx=True)
+    pipe.set(RERANK_SCHEDULED_KEY, 1, nx=True, ex=RERANK_SCHEDULED_TTL)
+    _, scheduled = pipe.execute()
+    if scheduled:
+        q.enqueue(JOB_update_links, result_ttl=0)
+
+
+def _pending_rerank():
+    """
+    Number of links waiting for re-ranking
+    """
+    pipe = cache.pipeline(transaction=False)
+    pipe.zcard(RERANK_PENDING_KEY)
+    pipe.zcard(RERANK_PROCESSING_KEY)
+    return sum(pipe.execute())
+
+
+def _rerank_lag():
+    """
+    Seconds since the longest waiting link was marked for re-ranking
+    """
+    pipe = cache.pipeline(transaction=False)
+    pipe.zrange(RERANK_PENDING_KEY, 0, 0, withscores=True)
+    pipe.zrange(RERANK_PROCESSING_KEY, 0, 0, withscores=True)
+    oldest = [x[0][1] for x in pipe.execute() if x]
+    return time() - min(oldest) if oldest else 0
+
+
+RERANK_PENDING.set_function(_pending_rerank)
+RERANK_LAG.set_function(_rerank_lag)
+
+
+def rerank_links(links):
+    """
+    Update score of links in all their listings with single batched insert
+    :param links: links with current score
+    """
+    updates = []
+    for link in links:
+        for sort in RERANK_SORTS:
+            updates.append((LinkQuery(feed_id=link.feed_id, sort=sort), [link]))
+            if GlobalLinkQuery.includes(link):
+                updates.append((GlobalLinkQuery(sort), [link]))
+    updates += home_listing_updates(links, RERANK_SORTS)
+    LinkQuery.insert_batch(updates)
 
 
 @job("medium", connection=redis_conn)
@@ -12,13 +88,44 @@ def JOB_update_link(updated_link):
     :param updated_link: link to update
     :return: nothing
     """
-    for sort in [
-        "trending",
-        "best",
-    ]:  # no need to update 'new' because it doesn't depend on score
-        LinkQuery(feed_id=updated_link.feed_id, sort=sort).insert([updated_link])
+    schedule_link_updates([updated_link.id])
+    return None
+
+
+@job("medium", connection=redis_conn)
+def JOB_update_links():
+    """
+    Re-rank links marked by schedule_link_updates
+    Links are loaded fresh so each of them is re-ranked once with its latest score,
+    pending links are moved to processing set first and deleted only after re-ranking
+    """
+    from news.models.link import Link
+
+    cache.delete(RERANK_SCHEDULED_KEY)
+
+    def rerank(ids):
+        links = Link.by_ids([int(id) for id in ids])
+        rerank_links([link for link in links if link is not None])
+
+    process_pending([RERANK_PENDING_KEY], rerank)
     return None
 
 
 def JOB_import_feed_fqs():
     import_fqs()
+
+
+@job("medium", connection=redis_conn)
+def JOB_update_fqs(ids):
+    """
+    Update Fully Qualified Sources dispatched by scheduler
+    :param ids: source ids
+    :return: nothing
+    """
+    from news.models.fully_qualified_source import FullyQualifiedSource
+
+    sources = FullyQualifiedSource.where_in("id", ids).get()
+    for id in set(ids) - {source.id for source in sources}:
+        unschedule(id)
+    update_sources(sources)
+    return None
@@ -0,0 +1,118 @@
+from orator.migrations import Migration
+
+LINK_VECTOR = (
+    "setweight(to_tsvector('english', coalesce({prefix}title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce({prefix}text, '')), 'B')"
+)
+FEED_VECTOR = (
+    "setweight(to_tsvector('english', coalesce({prefix}name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce({prefix}description, '')), 'B')"
+)
+
+
+class AddWeightedSearchVectors(Migration):
+    def up(self):
+        """
+        Run the migrations.
+        """
+        conn = self.schema.get_connection()
+        conn.statement(
+            str(
+                conn.raw(
+                    "ALTER TABLE links ADD COLUMN textsearchable tsvector; UPDATE links SET textsearchable = {};".format(
+                        LINK_VECTOR.format(prefix="")
+                    )
+                )
+            )
+        )
+        conn.statement(
+            str(
+                conn.raw(
+                    "CREATE OR REPLACE FUNCTION link_create_tsvectors()   \n"
+                    "RETURNS TRIGGER AS $$\n"
+                    "BEGIN\n"
+                    "    NEW.textsearchable_title = to_tsvector('english', NEW.title);\n"
+                    "    NEW.textsearchable_text = to_tsvector('english', NEW.text);\n"
+                    "    NEW.textsearchable = {};\n"
+                    "    RETURN NEW;\n"
+                    "END;\n"
+                    "$$ language 'plpgsql';".format(LINK_VECTOR.format(prefix="NEW."))
+                )
+            )
+        )
+        conn.statement(
+            str(
+                conn.raw(
+                    "CREATE INDEX link_textsearchable_idx ON links USING GIN (textsearchable);  "
+                )
+            )
+        )
+        conn.statement(
+            str(
+                conn.raw(
+                    "ALTER TABLE feeds ADD COLUMN textsearchable tsvector; UPDATE feeds SET textsearchable = {};".format(
+                        FEED_VECTOR.format(prefix="")
+                    )
+                )
+            )
+        )
+        conn.statement(
+            str(
+                conn.raw(
+                    "CREATE OR REPLACE FUNCTION feed_create_tsvectors()   \n"
+                    "RETURNS TRIGGER AS $$\n"
+                    "BEGIN\n"
+                    "    NEW.textsearchable_name = to_tsvector('english', NEW.name);\n"
+                    "    NEW.textsearchable_description = to_tsvector('english', NEW.description);\n"
+                    "    NEW.textsearchable = {};\n"
+                    "    RETURN NEW;\n"
+                    "END;\n"
+                    "$$ language 'plpgsql';".format(FEED_VECTOR.format(prefix="NEW."))
+                )
+            )
+        )
+        conn.statement(
+            str(
+                conn.raw(
+                    "CREATE INDEX feed_textsearchable_idx ON feeds USING GIN (textsearchable);  "
+                )
+            )
+        )
+
+    def down(self):
+        """
+        Revert the migrations.
+        """
+        conn = self.schema.get_connection()
+        conn.statement(
+            str(
+                conn.raw(
+                    "CREATE OR REPLACE FUNCTION link_create_tsvectors()   \n"
+                    "RETURNS TRIGGER AS $$\n"
+                    "BEGIN\n"
+                    "    NEW.textsearchable_title = to_tsvector('english', NEW.title);\n"
+                    "    NEW.textsearchable_text = to_tsvector('english', NEW.text);\n"
+                    "    RETURN NEW;\n"
+                    "END;\n"
+                    "$$ language 'plpgsql';"
+                )
+            )
+        )
+        conn.statement(
+            str(
+                conn.raw(
+                    "CREATE OR REPLACE FUNCTION feed_create_tsvectors()   \n"
+                    "RETURNS TRIGGER AS $$\n"
+                    "BEGIN\n"
+                    "    NEW.textsearchable_name = to_tsvector('english', NEW.name);\n"
+                    "    NEW.textsearchable_description = to_tsvector('english', NEW.description);\n"
+                    "    RETURN NEW;\n"
+                    "END;\n"
+                    "$$ language 'plpgsql';"
+                )
+            )
+        )
+        with self.schema.table("links") as table:
+            table.drop_column("textsearchable")
+        with self.schema.table("feeds") as table:
+            table.drop_column("textsearchable")
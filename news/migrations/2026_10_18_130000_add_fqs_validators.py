@@ -0,0 +1,19 @@
+from orator.migrations import Migration
+
+
+class AddFqsValidators(Migration):
+    def up(self):
+        """
+        Run the migrations.
+        """
+        with self.schema.table("fqs") as table:
+            table.text("etag").nullable()
+            table.text("last_modified").nullable()
+            table.string("content_hash", 32).nullable()
+
+    def down(self):
+        """
+        Revert the migrations.
+        """
+        with self.schema.table("fqs") as table:
+            table.drop_column("etag", "last_modified", "content_hash")
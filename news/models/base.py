@@ -6,7 +6,9 @@ import timeago
 from orator import Model
 from redis_lock import Lock
 
+from news.clients.db.db import db
 from news.lib.cache import cache
+from news.lib.counters import counters
 from news.lib.metrics import CACHE_HITS, CACHE_MISSES
 
 CACHE_EXPIRE_TIME = 12 * 60 * 60
@@ -19,8 +21,14 @@ class Base(Model):
     All models should use methods from this class to access and write to cache,
     If model-specific methods for cache access are needed be really careful
     when implementing them and try to use as much code from this class as possible
+
+    Models can declare __cache_schema__ to be cached in compact form instead of pickle
+    and __counters__ with attributes changed by incr and decr
     """
 
+    __cache_schema__ = None
+    __counters__ = []
+
     @property
     def b_id(self):
         return str(self.id).encode()
@@ -78,8 +86,11 @@ class Base(Model):
         """
         Update model from redis
         This is usually performed before updates or when updating for data consistency
+        so it always reads from Redis and never from the process local cache
         """
-        data = cache.get(self._cache_key)
+        data = cache.get(
+            self._cache_key, local=False, schema=self.__class__.__cache_schema__
+        )
         if data is not None:
             self.set_raw_attributes(data)
 
@@ -94,7 +105,9 @@ class Base(Model):
         __hidden__ attribute on class (more in documentation of orator)
         """
         # save token to redis for limited time
-        cache.set(self._cache_key, self.serialize())
+        cache.set(
+            self._cache_key, self.serialize(), schema=self.__class__.__cache_schema__
+        )
 
     @classmethod
     def load_from_cache(cls, id: str) -> object:
@@ -103,7 +116,7 @@ class Base(Model):
         :param id: id
         :return: model if found else None
         """
-        data = cache.get(cls._cache_key_from_id(id))
+        data = cache.get(cls._cache_key_from_id(id), schema=cls.__cache_schema__)
         if data is None:
             return None
         obj = cls()
@@ -114,30 +127,79 @@ class Base(Model):
     def incr(self, attr: str, amp: int = 1):
         """
         Increment given attribute
-        Increments model in both database and redis
+        Increments model in redis and in database, database is updated later
+        by JOB_flush_counters if counters are written behind
         :param attr: attribute
         :param amp: amplitude
         """
+        self.incr_many({attr: amp})
+
+    def incr_many(self, changes: dict):
+        """
+        Increment given attributes at once
+        Increments model in redis and in database, database is updated later
+        by JOB_flush_counters if counters are written behind
+        :param changes: {attribute: amplitude}
+        """
         with self.get_read_modify_write_lock():
             self.update_from_cache()
-            new_val = getattr(self, attr) + amp
-            self.set_attribute(attr, new_val)
-            self.__class__.where("id", self.id).increment(attr, amp)
+            for attr, amp in changes.items():
+                self.set_attribute(attr, getattr(self, attr) + amp)
+            if counters.write_behind:
+                pipe = cache.pipeline(transaction=False)
+                for attr, amp in changes.items():
+                    counters.add(self, attr, amp, pipe=pipe)
+                pipe.execute()
+            else:
+                for attr, amp in changes.items():
+                    self.__class__.where("id", self.id).increment(attr, amp)
             self.write_to_cache()
 
     def decr(self, attr: str, amp: int = 1):
         """
         Decrement given attribute
-        Decrements model in both database and redis
+        Decrements model in redis and in database, database is updated later
+        by JOB_flush_counters if counters are written behind
         :param attr: attribute
         :param amp: amplitude
         """
-        with self.get_read_modify_write_lock():
-            self.update_from_cache()
-            new_val = getattr(self, attr) - amp
-            self.set_attribute(attr, new_val)
-            self.__class__.where("id", self.id).decrement(attr, amp)
-            self.write_to_cache()
+        self.incr(attr, -amp)
+
+    @classmethod
+    def update_counters(cls, deltas: dict) -> list:
+        """
+        Write counter changes of multiple items to database with single UPDATE
+        :param deltas: {id: {attribute: change}}
+        :return: updated rows with id and new values of changed attributes
+        """
+        deltas = {
+            id: changes for id, changes in deltas.items() if any(changes.values())
+        }
+        if not deltas:
+            return []
+
+        attrs = sorted({attr for changes in deltas.values() for attr in changes})
+        for attr in attrs:
+            if attr not in cls.__counters__:
+                raise ValueError("Unknown counter {}".format(attr))
+
+        rows = [[id] + [deltas[id].get(attr, 0) for attr in attrs] for id in deltas]
+        query = (
+            "UPDATE {table} AS t SET {sets} "
+            "FROM (VALUES {values}) AS v (id, {attrs}) "
+            "WHERE t.id = v.id RETURNING t.id, {returning}"
+        ).format(
+            table=cls.__table__,
+            sets=", ".join("{0} = t.{0} + v.{0}".format(attr) for attr in attrs),
+            values=", ".join(
+                "({})".format(", ".join(["%s"] * len(row))) for row in rows
+            ),
+            attrs=", ".join(attrs),
+            returning=", ".join("t.{}".format(attr) for attr in attrs),
+        )
+        return db.select(
+            query, [x for row in rows for x in row], use_read_connection=False
+        )
 
     def set(self, attr: str, val: object):
         """
@@ -177,9 +239,20 @@ class Base(Model):
             return item
 
         CACHE_MISSES.inc(1)
+        pending_counters = counters.write_behind and cls.__counters__
+        flushes = counters.flushes() if pending_counters else 0
         # check db on fail
         item = cls.where("id", int(id)).first()
         if item is not None:
+            # database doesn't contain counter changes which weren't flushed yet
+            if pending_counters:
+                pending = counters.pending(item, cls.__counters__, flushes)
+                if pending is None:
+                    # counters are being flushed, next read caches them
+                    return item
+                for attr, change in pending.items():
+                    if change:
+                        item.set_raw_attribute(attr, getattr(item, attr) + change)
             item.write_to_cache()
 
         return item
@@ -196,7 +269,9 @@ class Base(Model):
         :param ids: list of ids of items to get
         :return: items
         """
-        items = cache.mget([cls._cache_key_from_id(id) for id in ids])
+        items = cache.mget(
+            [cls._cache_key_from_id(id) for id in ids], schema=cls.__cache_schema__
+        )
 
         # fetch missing items
         for idx, id in enumerate(ids):
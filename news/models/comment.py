@@ -1,13 +1,12 @@
 from markdown2 import markdown
 from orator import Schema
 from orator.orm import has_many, morph_many
-from redis_lock import Lock
 from werkzeug.utils import escape
 from wtforms import HiddenField, TextAreaField
 from wtforms.validators import DataRequired, Optional, Length
 
-from news.lib.cache import cache
-from news.lib.comments import add_new_comment
+from news.lib.cache import cache, CacheSchema, DEFAULT_CACHE_TTL, LuaScript
+from news.lib.comments import add_new_comment, bump_comments_generation
 from news.clients.db.db import db
 from news.lib.task_queue import q
 from news.lib.utils.confidence import confidence
@@ -30,6 +29,20 @@ class Comment(Base):
         "user_id",
     ]
     __hidden__ = ["link", "feed", "user", "votes", "reports"]
+    __counters__ = ["ups", "downs", "reported"]
+    __cache_schema__ = CacheSchema(
+        ("id", "int"),
+        ("parent_id", "int"),
+        ("text", "str"),
+        ("user_id", "int"),
+        ("link_id", "int"),
+        ("reported", "int"),
+        ("spam", "bool"),
+        ("ups", "int"),
+        ("downs", "int"),
+        ("created_at", "datetime"),
+        ("updated_at", "datetime"),
+    )
 
     @classmethod
     def create_table(cls):
@@ -159,15 +172,97 @@ class Comment(Base):
         # TODO REMOVE FROM CACHE
         self.text = escape("<removed>")
         self.update_with_cache()
+        bump_comments_generation(self.link_id)
 
 
 class TreeNotBuildException(Exception):
     pass
 
 
+# member of comment tree index which marks the tree as fully loaded from database
+LOADED_MEMBER = "_"
+
+# KEYS: tree index, children set of each added comment
+# ARGV: ttl, mark tree as loaded, parent id and comment id of each added comment
+# sets are only extended so adds racing with the tree load from database can't get lost,
+# index in the old pickled format is dropped and gets loaded again
+ADD_SCRIPT = LuaScript(
+    """
+if redis.call("TYPE", KEYS[1]).ok == "string" then
+    redis.call("DEL", KEYS[1])
+end
+for i = 2, #KEYS do
+    redis.call("SADD", KEYS[1], ARGV[i * 2 - 1])
+    redis.call("SADD", KEYS[i], ARGV[i * 2])
+    redis.call("EXPIRE", KEYS[i], ARGV[1])
+end
+if ARGV[2] == "1" then
+    redis.call("SADD", KEYS[1], "_")
+end
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    redis.call("EXPIRE", KEYS[1], ARGV[1])
+end
+"""
+)
+
+# KEYS: tree index
+# ARGV: ttl
+# returns parent ids followed by their children ids, nil if the tree isn't loaded or expired partially
+LOAD_SCRIPT = LuaScript(
+    """
+if redis.call("TYPE", KEYS[1]).ok ~= "set" or redis.call("SISMEMBER", KEYS[1], "_") == 0 then
+    return nil
+end
+local tree = {}
+for _, parent in ipairs(redis.call("SMEMBERS", KEYS[1])) do
+    if parent ~= "_" then
+        local key = KEYS[1] .. "." .. parent
+        local children = redis.call("SMEMBERS", key)
+        if #children == 0 then
+            return nil
+        end
+        redis.call("EXPIRE", key, ARGV[1])
+        tree[#tree + 1] = parent
+        tree[#tree + 1] = children
+    end
+end
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+return tree
+"""
+)
+
+
+# KEYS: sorted children
+# ARGV: ttl, mark children as loaded, confidence and comment id of each added comment
+# comments loaded from database don't overwrite newer confidences
+SORTED_ADD_SCRIPT = LuaScript(
+    """
+if redis.call("TYPE", KEYS[1]).ok == "string" then
+    redis.call("DEL", KEYS[1])
+end
+for i = 3, #ARGV, 2 do
+    if ARGV[2] == "1" then
+        redis.call("ZADD", KEYS[1], "NX", ARGV[i], ARGV[i + 1])
+    else
+        redis.call("ZADD", KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+if ARGV[2] == "1" then
+    redis.call("ZADD", KEYS[1], "-inf", "_")
+end
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    redis.call("EXPIRE", KEYS[1], ARGV[1])
+end
+"""
+)
+
+
 class CommentTree:
     """
     CommentTree is interface to unordered comment tree for given link
+
+    The tree is stored in redis as set of children ids per parent comment and index set of parent ids
+    Adding a comment is single append without any lock, whole tree is loaded by single script call
     """
 
     def __init__(self, link_id):
@@ -178,17 +273,26 @@ class CommentTree:
     def _cache_key(self):
         return "ct:{}".format(self.link_id)
 
-    @property
-    def _lock_key(self):
+    def _children_key(self, parent_id):
+        return "ct:{}.{}".format(self.link_id, parent_id or 0)
+
+    def _add(self, comments: ["Comment"], loaded: bool = False):
         """
-        Gets lock key for read/modify/write operations
-        :param link: link
-        :return: redis key
+        Add comments to cached tree
+        :param comments: comments
+        :param loaded: whether the comments are all comments of the link
         """
-        return "c_lock:{}".format(self.link_id)
+        args = [DEFAULT_CACHE_TTL, int(loaded)]
+        for comment in comments:
+            args += [comment.parent_id or 0, comment.id]
+        ADD_SCRIPT(
+            keys=[self._cache_key]
+            + [self._children_key(comment.parent_id) for comment in comments],
+            args=args,
+        )
 
     def create(self):
-        cache.set(self._cache_key, {})
+        self._add([], loaded=True)
 
     def add(self, comments: ["Comment"]):
         """
@@ -196,40 +300,28 @@ class CommentTree:
         :param link: link
         :param comment: comment
         """
-        with Lock(cache.conn, self._lock_key):
-            tree = self.load_tree()
-            for comment in comments:
-                tree.setdefault(comment.parent_id, []).append(comment.id)
-            cache.set(self._cache_key, tree)
-
-    def remove(self, comments: ["Comment"]):
-        """
-        Remove comments from comment tree
-        :param comments: comments
-        """
-        with Lock(cache.conn, self._lock_key):
-            tree = self.load_tree()
-            for comment in comments:
-                tree[comment.parent_id] = [
-                    id for id in tree[comment.parent_id] if id != comment.id
-                ]
-            cache.set(self._cache_key, tree)
+        self._add(comments)
 
     def load_tree(self) -> dict:
         """
         Load the tree
         :return: tree
         """
-        tree = cache.get(self._cache_key)
-        if not tree:
+        data = LOAD_SCRIPT(keys=[self._cache_key], args=[DEFAULT_CACHE_TTL])
+        if data is None:
             comments = (
                 Comment.where("link_id", self.link_id).select("parent_id", "id").get()
                 or []
             )
+            self._add(comments, loaded=True)
             tree = {}
             for comment in comments:
                 tree.setdefault(comment.parent_id, []).append(comment.id)
-            cache.set(self._cache_key, tree)
+        else:
+            tree = {
+                int(parent_id) or None: [int(id) for id in children_ids]
+                for parent_id, children_ids in zip(data[::2], data[1::2])
+            }
         self._tree = tree
         return tree
 
@@ -270,7 +362,7 @@ class SortedComments:
     """
     SortedComments class allows access to sorted comments for links
 
-    Sorted comments are stored in redis
+    Sorted comments are stored in redis as sorted sets scored by confidence
     Key is combination of link id and parent comment id (root comments don't have parent comment id)
     This way all we need to do to update the tree is update comments only under the parent comment
     To get the tree we recursively traverse the tree a fetch children comments
@@ -283,8 +375,18 @@ class SortedComments:
     def _cache_key(self, parent_id):
         return "scm:{}.{}".format(self._link_id, parent_id or 0)
 
-    def _lock_key(self, parent_id):
-        return "lock:scm:{}.{}".format(self._link_id, parent_id or 0)
+    def _add(self, parent_id, comments: ["Comment"], loaded: bool = False, pipe=None):
+        """
+        Add comments to sorted children of parent comment
+        :param parent_id: parent comment id
+        :param comments: comments
+        :param loaded: whether the comments are all children of the parent comment
+        :param pipe: optional pipeline
+        """
+        args = [DEFAULT_CACHE_TTL, int(loaded)]
+        for comment in comments:
+            args += [confidence(comment.ups, comment.downs), comment.id]
+        SORTED_ADD_SCRIPT(keys=[self._cache_key(parent_id)], args=args, client=pipe)
 
     def update(self, comments: ["Comment"]):
         """
@@ -293,87 +395,153 @@ class SortedComments:
         :param link_id: link id
         :param comment: comment
         """
+        by_parent = {}
         for comment in comments:
-            cache_key = self._cache_key(comment.parent_id)
-            lock_key = self._lock_key(comment.parent_id)
-
-            # update comment under read - write - modify lock
-            with Lock(cache.conn, lock_key):
-                # maybe check against the comment tree to see if it is missing or it just is not initialized yet
-                comments = (
-                    cache.get(cache_key) or []
-                )  # so maybe load comments instead of []
-
-                # update comment
-                for i in range(len(comments)):
-                    if comments[i][0] == comment.id:
-                        comments[i] = [
-                            comment.id,
-                            confidence(comment.ups, comment.downs),
-                        ]
-                        break
-                else:
-                    # add comment
-                    comments.append(
-                        [comment.id, confidence(comment.ups, comment.downs)]
-                    )
-
-                # sort and save
-                comments = sorted(comments, key=lambda x: x[1:], reverse=True)
-                cache.set(cache_key, comments)
-
-    def build_tree(self):
-        """
-        Build sorted tree of comments for given comment_id
-        If comment_id is None, tree for whole link is build
-        :param comment_id: comment_id for comment, None for link
-        :return: (comment_id, [sorted subtrees])
-        """
-        # load all comments that will be needed
-        comment_ids = self._tree.ids()
-        comments = (
-            {comment.id: comment for comment in Comment.by_ids(comment_ids)}
-            if comment_ids
-            else {}
-        )
-        comments.setdefault(None)
-
-        ids = self._tree.keys()
-        children_tuples = cache.mget([self._cache_key(id) for id in ids]) if ids else []
-        for idx, parent_id in enumerate(ids):
-            # fill in missing children
-            if children_tuples[idx] is None:
+            by_parent.setdefault(comment.parent_id, []).append(comment)
+
+        pipe = cache.pipeline(transaction=False)
+        for parent_id, children in by_parent.items():
+            self._add(parent_id, children, pipe=pipe)
+        pipe.execute()
+
+    def _sorted_children(self, pages: dict) -> dict:
+        """
+        Load sorted children of given parent comments
+        :param pages: {parent_id: (start, end)}, end None for all children
+        :return: {parent_id: ([comment_id], number of children)}
+        """
+        parent_ids = list(pages.keys())
+        pipe = cache.pipeline(transaction=False)
+        for parent_id in parent_ids:
+            start, end = pages[parent_id]
+            key = self._cache_key(parent_id)
+            pipe.zscore(key, LOADED_MEMBER)
+            pipe.zcard(key)
+            pipe.zrevrange(key, start, end - 1 if end is not None else -1)
+        data = pipe.execute(raise_on_error=False)
+
+        result = {}
+        for idx, parent_id in enumerate(parent_ids):
+            key = self._cache_key(parent_id)
+            loaded, count, ids = data[idx * 3 : idx * 3 + 3]
+            # fill in missing children, values in the old pickled format raise errors
+            if loaded is None or isinstance(loaded, Exception):
                 children = (
                     Comment.where("parent_id", parent_id)
                     .where("link_id", self._link_id)
                     .get()
                 )
-                tuples = [[x.id, confidence(x.ups, x.downs)] for x in children]
-                children_tuples[idx] = sorted(tuples, key=lambda x: x[1:], reverse=True)
-                cache.set(self._cache_key(parent_id), children_tuples[idx])
+                self._add(parent_id, children, loaded=True)
+                start, end = pages[parent_id]
+                pipe = cache.pipeline(transaction=False)
+                pipe.zcard(key)
+                pipe.zrevrange(key, start, end - 1 if end is not None else -1)
+                count, ids = pipe.execute()
+            result[parent_id] = (
+                [int(id) for id in ids if id != LOADED_MEMBER.encode()],
+                count - 1,
+            )
+        return result
+
+    def build_tree(
+        self,
+        parent_id=None,
+        offset: int = 0,
+        limit: int = None,
+        depth: int = None,
+        children: int = None,
+    ):
+        """
+        Build sorted tree of comments under given parent comment
+        Only comments which fit into the limits are loaded, the rest is available through continuations
+        :param parent_id: parent comment id, None for root comments of link
+        :param offset: number of skipped children of the parent comment
+        :param limit: maximal number of children of the parent comment, None for all
+        :param depth: maximal depth of the tree, None for unlimited
+        :param children: maximal number of children of nested comments, None for all
+        :return: ([[comment, [sorted subtrees], continuation]], continuation)
+        """
+        tree = self._tree.load_tree()
+
+        # load sorted children level by level, only for comments that will be displayed
+        pages, level, parents = {}, 0, [parent_id]
+        while parents and (depth is None or level < depth):
+            parents = [id for id in parents if id in tree]
+            if not parents:
+                break
+            start = offset if level == 0 else 0
+            count = limit if level == 0 else children
+            end = start + count if count is not None else None
+            sorted_children = self._sorted_children(
+                {id: (start, end) for id in parents}
+            )
+            next_parents = []
+            for id in parents:
+                ids, total = sorted_children[id]
+                more = (
+                    continuation(id, end) if end is not None and end < total else None
+                )
+                pages[id] = (ids, more)
+                next_parents += ids
+            parents = next_parents
+            level += 1
 
-        builder = dict(zip(ids, children_tuples))
+        comment_ids = [id for ids, _ in pages.values() for id in ids]
+        comments = (
+            {
+                comment.id: comment
+                for comment in Comment.by_ids(comment_ids)
+                if comment is not None
+            }
+            if comment_ids
+            else {}
+        )
 
         # subtree builder
         def build_subtree(parent):
-            return [
-                comments[parent],
-                [build_subtree(children_id) for children_id, _ in builder[parent]]
-                if parent in builder
-                else [],
-            ]
+            if parent not in pages:
+                # children of comments at the maximal depth are left for continuation
+                return [], continuation(parent, 0) if parent in tree else None
+            ids, more = pages[parent]
+            return (
+                [[comments[id], *build_subtree(id)] for id in ids if id in comments],
+                more,
+            )
 
-        return build_subtree(None)
+        return build_subtree(parent_id)
 
     def get_full_tree(self):
         """
         Gets full comment tree for given Link
         :return: Sorted Comments tree
         """
-        _, tree = self.build_tree()
+        tree, _ = self.build_tree()
         return tree
 
 
+def continuation(parent_id, offset: int) -> str:
+    """
+    Continuation token of comment tree
+    :param parent_id: parent comment id
+    :param offset: number of already displayed children
+    :return: continuation token
+    """
+    return "{}.{}".format(parent_id or 0, offset)
+
+
+def parse_continuation(token: str) -> (int, int):
+    """
+    Parse continuation token of comment tree
+    :param token: continuation token
+    :return: parent comment id, offset
+    :raises ValueError: if the token is malformed
+    """
+    parent_id, offset = (int(x) for x in token.split("."))
+    if parent_id < 0 or offset < 0:
+        raise ValueError("invalid continuation {}".format(token))
+    return parent_id or None, offset
+
+
 class CommentForm(BaseForm):
     text = TextAreaField("comment", [DataRequired(), Length(max=8192)])
     parent_id = HiddenField(
@@ -8,7 +8,8 @@ from rq.decorators import job
 from wtforms import StringField, TextAreaField, FileField
 from wtforms.validators import DataRequired, Length
 
-from news.lib.cache import cache
+from news.lib.autocomplete import add_feeds, remove_feed
+from news.lib.cache import cache, CacheSchema
 from news.clients.db.db import db
 from news.lib.task_queue import redis_conn, q
 from news.lib.utils.slugify import make_slug
@@ -35,6 +36,23 @@ class Feed(Base):
     ]
     __searchable__ = ["name", "description"]
     __hidden__ = ["users"]
+    __counters__ = ["subscribers_count"]
+    __cache_schema__ = CacheSchema(
+        ("id", "int"),
+        ("name", "str"),
+        ("slug", "str"),
+        ("description", "str"),
+        ("rules", "str"),
+        ("img", "str"),
+        ("subscribers_count", "int"),
+        ("default_sort", "str"),
+        ("lang", "str"),
+        ("over_18", "bool"),
+        ("logo", "str"),
+        ("reported", "bool"),
+        ("created_at", "datetime"),
+        ("updated_at", "datetime"),
+    )
 
     @classmethod
     def create_table(cls):
@@ -156,8 +174,20 @@ class Feed(Base):
             cache.set(self.rules_cache_key, rules)
         return rules
 
+    def update_with_cache(self):
+        """
+        Update feed, renamed feed is reindexed for autocomplete
+        """
+        renamed = self.is_dirty("name", "slug")
+        slug, name = self.get_original("slug"), self.get_original("name")
+        super().update_with_cache()
+        if renamed:
+            remove_feed(slug, name)
+            add_feeds([self])
+
     def commit(self):
         self.save()
+        add_feeds([self])
         q.enqueue(handle_new_feed, self, result_ttl=0)
 
 
@@ -1,11 +1,17 @@
 from datetime import datetime, timedelta
+from hashlib import md5
 
 import feedparser
 from orator import accessor, mutator
 
+from news.lib.fqs_fetcher import Fetcher, FetchResult
+from news.lib.metrics import FQS_UNCHANGED
 from news.lib.utils.slugify import make_slug, remove_html_tags
 from news.models.base import Base
 
+# user posting links from Fully Qualified Sources
+AUTOPOSTER_ID = 12345
+
 
 class FullyQualifiedSource(Base):
     """Fully Qualified Sources are RSS feeds from which the links are automatically posted to given feed
@@ -18,6 +24,9 @@ class FullyQualifiedSource(Base):
         feed_id (int): Id of feed to which this FQS belongs
         url (string): RSS feed URL
         update_interval (timedelta): Time between automatic checks
+        etag (string): ETag of the last fetched document
+        last_modified (string): Last-Modified of the last fetched document
+        content_hash (string): MD5 of the last fetched document
     """
 
     __table__ = "fqs"
@@ -29,6 +38,9 @@ class FullyQualifiedSource(Base):
         "updated_at",
         "created_at",
         "next_update",
+        "etag",
+        "last_modified",
+        "content_hash",
     ]
 
     @classmethod
@@ -76,7 +88,48 @@ class FullyQualifiedSource(Base):
         Get new links
         :return:
         """
-        d = feedparser.parse(self.url)
+        result = Fetcher(workers=1).fetch(self)
+        if result.error is not None:
+            raise result.error
+        if not self.changed(result):
+            return []
+        return self.parse_links(result.data)
+
+    def changed(self, result: FetchResult) -> bool:
+        """
+        Check whether fetched document changed since the previous processed fetch,
+        unchanged documents don't have to be parsed at all
+        :param result: successful fetch result
+        :return: changed?
+        """
+        if result.not_modified:
+            FQS_UNCHANGED.labels("not_modified").inc()
+            return False
+        if md5(result.data).hexdigest() == self.content_hash:
+            FQS_UNCHANGED.labels("same_content").inc()
+            return False
+        return True
+
+    def processed(self, result: FetchResult):
+        """
+        Remember validators of fetched document once its links got posted,
+        document which failed to be processed is fetched and processed again next time
+        Changes are saved together with the next update time
+        :param result: successful fetch result
+        """
+        if result.not_modified:
+            return
+        self.etag = result.etag
+        self.last_modified = result.last_modified
+        self.content_hash = md5(result.data).hexdigest()
+
+    def parse_links(self, data: bytes):
+        """
+        Parse links from fetched RSS document
+        :param data: RSS document
+        :return:
+        """
+        d = feedparser.parse(data)
 
         if d["bozo"] == 1:
             raise NameError
@@ -121,3 +174,26 @@ class FullyQualifiedSource(Base):
                 }
             )
         return res
+
+    def post_links(self, articles: [dict]) -> ["Link"]:
+        """
+        Post articles which weren't posted yet
+        Articles are deduplicated by slug with single lookup and inserted with single query
+        :param articles: parsed articles
+        :return: posted links
+        """
+        from news.models.link import Link
+
+        existing = Link.existing_slugs([article["slug"] for article in articles])
+        new = {}
+        for article in articles:
+            if article["slug"] not in existing and article["slug"] not in new:
+                new[article["slug"]] = Link(
+                    title=article["title"],
+                    slug=article["slug"],
+                    text=article["text"],
+                    url=article["url"],
+                    feed_id=self.feed_id,
+                    user_id=AUTOPOSTER_ID,
+                )
+        return Link.insert_many(list(new.values()))
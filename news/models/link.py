@@ -8,10 +8,17 @@ from wtforms import StringField, TextAreaField
 from wtforms.fields.html5 import URLField
 from wtforms.validators import DataRequired, Length
 
-from news.lib.cache import cache
+from news.lib.autocomplete import remove_link
+from news.lib.cache import cache, CacheSchema, DEFAULT_CACHE_TTL
 from news.clients.db.db import db
-from news.clients.db.query import JOB_add_to_queries, LinkQuery
+from news.clients.db.query import (
+    JOB_add_to_queries,
+    JOB_add_links_to_queries,
+    LinkQuery,
+    GlobalLinkQuery,
+)
 from news.clients.db.sorts import sorts
+from news.lib.home_listing import remove_from_home_listings
 from news.lib.sorts import hot
 from news.lib.task_queue import q
 from news.lib.utils.slugify import make_slug
@@ -43,6 +50,25 @@ class Link(Base):
     ]
     __searchable__ = ["title", "text"]
     __hidden__ = ["user", "feed"]
+    __counters__ = ["ups", "downs", "comments_count", "reported"]
+    __cache_schema__ = CacheSchema(
+        ("id", "int"),
+        ("title", "str"),
+        ("slug", "str"),
+        ("text", "str"),
+        ("image", "str"),
+        ("url", "str"),
+        ("user_id", "int"),
+        ("feed_id", "int"),
+        ("ups", "int"),
+        ("downs", "int"),
+        ("comments_count", "int"),
+        ("archived", "bool"),
+        ("reported", "int"),
+        ("spam", "bool"),
+        ("created_at", "datetime"),
+        ("updated_at", "datetime"),
+    )
 
     @classmethod
     def create_table(cls):
@@ -121,6 +147,82 @@ class Link(Base):
 
         return Link.by_id(id) if id else None
 
+    @classmethod
+    def existing_slugs(cls, slugs: [str]) -> set:
+        """
+        Get which of given slugs are already used
+        All slugs are looked up with single MGET, slugs missing in cache with single query
+        :param slugs: slugs
+        :return: used slugs
+        """
+        slugs = list(set(slugs))
+        if not slugs:
+            return set()
+
+        ids = cache.mget(["lslug:{}".format(slug) for slug in slugs])
+        existing = {slug for slug, id in zip(slugs, ids) if id is not None}
+        missing = [slug for slug, id in zip(slugs, ids) if id is None]
+        if missing:
+            rows = db.select(
+                "SELECT id, slug FROM {} WHERE slug IN ({})".format(
+                    cls.__table__, ", ".join(["%s"] * len(missing))
+                ),
+                missing,
+            )
+            cls._cache_slugs({row["slug"]: row["id"] for row in rows})
+            existing.update(row["slug"] for row in rows)
+        return existing
+
+    @staticmethod
+    def _cache_slugs(ids: dict):
+        """
+        Cache ids of multiple links by their slugs with single pipeline
+        :param ids: {slug: id}
+        """
+        pipe = cache.pipeline(transaction=False)
+        for slug, id in ids.items():
+            pipe.setex(
+                "lslug:{}".format(slug), DEFAULT_CACHE_TTL, cache.codec.encode(id)
+            )
+        pipe.execute()
+
+    @classmethod
+    def insert_many(cls, links: ["Link"]) -> ["Link"]:
+        """
+        Insert new links with single multi-row INSERT
+        Links are cached and added to listings with single job
+        :param links: new links
+        :return: inserted links
+        """
+        if not links:
+            return []
+
+        now = cls().fresh_timestamp()
+        attrs = ["title", "slug", "text", "url", "feed_id", "user_id"]
+        rows = [[getattr(link, attr) for attr in attrs] + [now, now] for link in links]
+        query = (
+            "INSERT INTO {table} ({attrs}, created_at, updated_at) "
+            "VALUES {values} RETURNING *"
+        ).format(
+            table=cls.__table__,
+            attrs=", ".join(attrs),
+            values=", ".join(
+                "({})".format(", ".join(["%s"] * len(row))) for row in rows
+            ),
+        )
+        inserted = []
+        for row in db.select(
+            query, [x for row in rows for x in row], use_read_connection=False
+        ):
+            link = cls()
+            link.set_raw_attributes(dict(row))
+            link.set_exists(True)
+            inserted.append(link)
+
+        cls._cache_slugs({link.slug: link.id for link in inserted})
+        q.enqueue(JOB_add_links_to_queries, inserted, result_ttl=0)
+        return inserted
+
     @property
     def user(self) -> "User":
         """
@@ -133,6 +235,34 @@ class Link(Base):
             self._relations["user"] = User.by_id(self.user_id)
         return self._relations["user"]
 
+    @classmethod
+    def preload(cls, links: ["Link"], relations=("feed", "user"), user=None):
+        """
+        Preload relations of multiple links at once
+        Each relation is loaded with single mget instead of one cache hit per link when rendering listings
+        :param links: links
+        :param relations: relations to preload, "feed" and/or "user"
+        :param user: current user, feed administrations of the user are preloaded for link feeds
+        :return: links
+        """
+        from news.models.feed import Feed
+        from news.models.user import User
+
+        present = [link for link in links if link is not None]
+
+        models = {"feed": (Feed, "feed_id"), "user": (User, "user_id")}
+        for relation in relations:
+            model, attr = models[relation]
+            ids = list({getattr(link, attr) for link in present})
+            items = dict(zip(ids, model.by_ids(ids))) if ids else {}
+            for link in present:
+                link._relations[relation] = items[getattr(link, attr)]
+
+        if user is not None and user.is_authenticated:
+            user.preload_feed_admin({link.feed_id for link in present})
+
+        return links
+
     @property
     def trimmed_summary(self):
         """
@@ -285,6 +415,10 @@ class Link(Base):
         ]:  # no need to update 'new' because it doesn't depend on score
             q = LinkQuery(feed_id=self.feed_id, sort=sort)
             q.delete([self])
+            if GlobalLinkQuery.includes(self):
+                GlobalLinkQuery(sort).delete([self])
+        remove_from_home_listings(self, ["trending", "best", "new"])
+        remove_link(self)
         super().delete()
         cache.delete(self._cache_key)
 
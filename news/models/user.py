@@ -20,8 +20,10 @@ from wtforms import (
 from wtforms.fields.html5 import EmailField, URLField
 from wtforms.validators import DataRequired, URL, Length, NumberRange
 
-from news.lib.cache import cache
+from news.lib.autocomplete import add_feeds
+from news.lib.cache import cache, CacheSchema
 from news.clients.db.db import db
+from news.lib.home_listing import drop_home_listing
 from news.lib.login import login_manager
 from news.clients.mail import reset_email, JOB_send_mail
 from news.lib.task_queue import q, redis_conn
@@ -67,8 +69,30 @@ class User(Base):
         "lu",
         "cd",
         "cu",
+        "fa",
     ]
     __append__ = ["session_token"]
+    __counters__ = ["feed_subs"]
+    __cache_schema__ = CacheSchema(
+        ("id", "int"),
+        ("username", "str"),
+        ("full_name", "str"),
+        ("email", "str"),
+        ("email_verified", "bool"),
+        ("subscribed", "bool"),
+        ("email_public", "bool"),
+        ("reported", "int"),
+        ("spammer", "bool"),
+        ("preferred_sort", "str"),
+        ("bio", "str"),
+        ("url", "str"),
+        ("feed_subs", "int"),
+        ("p_infinite_scrolling", "bool"),
+        ("p_show_summaries", "bool"),
+        ("p_min_link_score", "int"),
+        ("created_at", "datetime"),
+        ("updated_at", "datetime"),
+    )
 
     @classmethod
     def create_table(cls, database):
@@ -339,9 +363,12 @@ class User(Base):
 
         self.incr("feed_subs", 1)
         self.update_with_cache()
+        drop_home_listing(self.id)
 
         # TODO DO IN QUEUE
         feed.incr("subscribers_count", 1)
+        # subscribers are the score of the feed in autocomplete
+        add_feeds([feed])
         return True
 
     def unsubscribe(self, feed: "Feed"):
@@ -352,11 +379,14 @@ class User(Base):
 
         # TODO DO IN QUEUE
         feed.decr("subscribers_count", 1)
+        # subscribers are the score of the feed in autocomplete
+        add_feeds([feed])
         key = "subs:{}".format(self.id)
         ids = cache.get(key)
         if ids is not None:
             ids = [id for id in ids if id != feed.id]
             cache.set(key, ids)
+        drop_home_listing(self.id)
         return True
 
     @classmethod
@@ -389,15 +419,42 @@ class User(Base):
     def is_god(self) -> bool:
         return self.is_authenticated and self.username in current_app.config["GODS"]
 
+    def preload_feed_admin(self, feed_ids):
+        """
+        Load users administrations of given feeds with single query
+        :param feed_ids: feed ids
+        """
+        administrations = self._relations.setdefault("fa", {})
+        missing = [fid for fid in feed_ids if fid not in administrations]
+        if not missing:
+            return
+        for fid in missing:
+            administrations[fid] = None
+        for admin in (
+            FeedAdmin.where("user_id", self.id).where_in("feed_id", missing).get()
+        ):
+            administrations[admin.feed_id] = admin
+
+    def _feed_admin(self, feed: "Feed") -> Optional["FeedAdmin"]:
+        """
+        Get users administration of given feed
+        :param feed: feed
+        :return: feed administration or None
+        """
+        administrations = self._relations.setdefault("fa", {})
+        if feed.id not in administrations:
+            administrations[feed.id] = FeedAdmin.by_user_and_feed_id(self.id, feed.id)
+        return administrations[feed.id]
+
     def is_feed_admin(self, feed: "Feed") -> bool:
         if not self.is_authenticated:
             return False
-        return FeedAdmin.by_user_and_feed_id(self.id, feed.id) is not None
+        return self._feed_admin(feed) is not None
 
     def is_feed_god(self, feed: "Feed") -> bool:
         if not self.is_authenticated:
             return False
-        feed_admin = FeedAdmin.by_user_and_feed_id(self.id, feed.id)
+        feed_admin = self._feed_admin(feed)
         return feed_admin.god if feed_admin is not None else False
 
     def is_baned_from(self, feed: "Feed") -> bool:
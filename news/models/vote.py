@@ -1,17 +1,107 @@
 from orator import Model, accessor, Schema
 from orator.orm import belongs_to
 
-from news.lib.cache import cache, DEFAULT_CACHE_TTL
+from news.lib.cache import cache, DEFAULT_CACHE_TTL, LuaScript, process_pending
 from news.lib.comments import update_comment
 from news.clients.db.db import db
 from news.lib.task_queue import q
-from news.lib.tasks.tasks import JOB_update_link
+from news.lib.tasks.tasks import schedule_link_updates
 from news.models.comment import Comment
 
 UPVOTE = 1
 UNVOTE = 0
 DOWNVOTE = -1
 
+# write-behind log of applied votes as {thing cache key}:{user id}:{vote type}
+PENDING_VOTES_KEY = "votes:pending"
+# cache keys of things which should be re-ranked after their votes get written
+RERANK_KEY = "votes:rerank"
+# set while flush of pending votes is scheduled
+FLUSH_SCHEDULED_KEY = "votes:flush"
+# seconds after which the flush is scheduled again if the scheduled one got lost
+FLUSH_SCHEDULED_TTL = 60
+
+# member of cached vote sets which distinguishes empty sets from sets that aren't cached
+LOADED_MEMBER = "_"
+
+# results of vote script
+VOTE_NOT_LOADED = -1
+VOTE_UNCHANGED = 0
+VOTE_APPLIED = 1
+VOTE_FLUSH = 2
+
+# KEYS: upvotes set, downvotes set, pending votes, re-rank set, flush flag
+# ARGV: thing cache key, thing id, user id, vote type, number of votes on thing, ttl, flush flag ttl
+# returns result and previous vote type
+VOTE_SCRIPT = LuaScript(
+    """
+local up, down = KEYS[1], KEYS[2]
+local thing, id = ARGV[1], ARGV[2]
+if redis.call("SISMEMBER", up, "_") == 0 or redis.call("SISMEMBER", down, "_") == 0 then
+    return {-1, 0}
+end
+
+local previous = 0
+if redis.call("SISMEMBER", up, id) == 1 then
+    previous = 1
+elseif redis.call("SISMEMBER", down, id) == 1 then
+    previous = -1
+end
+local vote = tonumber(ARGV[4])
+if previous == vote then
+    return {0, previous}
+end
+
+if previous == 1 then
+    redis.call("SREM", up, id)
+elseif previous == -1 then
+    redis.call("SREM", down, id)
+end
+if vote == 1 then
+    redis.call("SADD", up, id)
+elseif vote == -1 then
+    redis.call("SADD", down, id)
+end
+redis.call("EXPIRE", up, ARGV[6])
+redis.call("EXPIRE", down, ARGV[6])
+redis.call("RPUSH", KEYS[3], thing .. ":" .. ARGV[3] .. ":" .. ARGV[4])
+
+local votes = tonumber(ARGV[5])
+if votes < 20 or votes % 8 == 0 then
+    redis.call("SADD", KEYS[4], thing)
+end
+
+if redis.call("SET", KEYS[5], 1, "NX", "EX", ARGV[7]) then
+    return {2, previous}
+end
+return {1, previous}
+"""
+)
+
+# KEYS: upvotes set, downvotes set
+# ARGV: ttl, number of upvotes, upvoted ids..., downvoted ids...
+LOAD_VOTES_SCRIPT = LuaScript(
+    """
+if redis.call("SISMEMBER", KEYS[1], "_") == 1 and redis.call("SISMEMBER", KEYS[2], "_") == 1 then
+    return 0
+end
+redis.call("DEL", KEYS[1], KEYS[2])
+redis.call("SADD", KEYS[1], "_")
+redis.call("SADD", KEYS[2], "_")
+local ups = tonumber(ARGV[2])
+for i = 3, #ARGV do
+    if i - 2 <= ups then
+        redis.call("SADD", KEYS[1], ARGV[i])
+    else
+        redis.call("SADD", KEYS[2], ARGV[i])
+    end
+end
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+redis.call("EXPIRE", KEYS[2], ARGV[1])
+return 1
+"""
+)
+
 
 def vote_type_from_string(str):
     str = str.upper()
@@ -94,25 +184,110 @@ class Vote(Model):
             return "ups"
         return None
 
+    @classmethod
+    def load_user_votes(cls, user_id):
+        """
+        Load votes of given user from database into vote sets
+        Sets which are already cached are kept as they may contain votes not written to database yet
+        :param user_id: user id
+        """
+        # need timestamps to add .where('created_at', '<', 'NOW() - INTERVAL \'30 days\'')
+        votes = (
+            cls.where("user_id", "=", user_id).where("vote_type", "!=", UNVOTE).get()
+        )
+        ups = [vote._thing_id for vote in votes if vote.vote_type == UPVOTE]
+        downs = [vote._thing_id for vote in votes if vote.vote_type == DOWNVOTE]
+        LOAD_VOTES_SCRIPT(
+            keys=[cls._set_key(user_id, UPVOTE), cls._set_key(user_id, DOWNVOTE)],
+            args=[DEFAULT_CACHE_TTL, len(ups)] + ups + downs,
+        )
+
     @classmethod
     def by_user_and_vote_type(cls, user_id, vote_type):
         set_key = cls._set_key(user_id, vote_type)
         vote_ids = cache.smembers(set_key)
-        if not vote_ids:
-            # need timestamps to add .where('created_at', '<', 'NOW() - INTERVAL \'30 days\'')
-            votes = (
-                cls.where("user_id", "=", user_id)
-                .where("vote_type", "=", vote_type)
-                .get()
-            )
-            vote_ids = [str(vote._thing_id).encode() for vote in votes]
-            if vote_ids:
-                pipe = cache.pipeline()
-                pipe.sadd(set_key, *vote_ids)
-                pipe.expire(set_key, DEFAULT_CACHE_TTL)
-                pipe.execute()
+        if LOADED_MEMBER.encode() not in vote_ids:
+            cls.load_user_votes(user_id)
+            vote_ids = cache.smembers(set_key)
+        vote_ids.discard(LOADED_MEMBER.encode())
         return set(vote_ids)
 
+    @classmethod
+    def _thing_prefix(cls):
+        """
+        Return cache prefix of things voted on
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def _thing_column(cls):
+        """
+        Return column with id of the thing voted on
+        """
+        raise NotImplementedError
+
+    def apply(self, thing=None):
+        """
+        Apply the vote
+        Vote sets are updated in cache by single script and votes are written to database later
+        by JOB_flush_votes, ups and downs of the thing are changed right away as other counters
+        :param thing: thing voted on if it's already loaded
+        """
+        thing = thing if thing is not None else self.thing
+        keys = [
+            self._set_key(self.user_id, UPVOTE),
+            self._set_key(self.user_id, DOWNVOTE),
+            PENDING_VOTES_KEY,
+            RERANK_KEY,
+            FLUSH_SCHEDULED_KEY,
+        ]
+        args = [
+            "{}{}".format(self._thing_prefix(), self._thing_id),
+            self._thing_id,
+            self.user_id,
+            self.vote_type,
+            thing.num_votes,
+            DEFAULT_CACHE_TTL,
+            FLUSH_SCHEDULED_TTL,
+        ]
+
+        result, previous = VOTE_SCRIPT(keys=keys, args=args)
+        if result == VOTE_NOT_LOADED:
+            self.load_user_votes(self.user_id)
+            result, previous = VOTE_SCRIPT(keys=keys, args=args)
+        if result == VOTE_UNCHANGED:
+            return
+
+        changes = {}
+        for vote_type, amp in ((previous, -1), (self.vote_type, 1)):
+            if vote_type == UPVOTE:
+                changes["ups"] = changes.get("ups", 0) + amp
+            elif vote_type == DOWNVOTE:
+                changes["downs"] = changes.get("downs", 0) + amp
+        thing.incr_many(changes)
+
+        if result == VOTE_FLUSH:
+            q.enqueue(JOB_flush_votes, result_ttl=0)
+
+    @classmethod
+    def upsert_many(cls, votes):
+        """
+        Write votes to database with single INSERT
+        :param votes: list of (user id, thing id, vote type)
+        """
+        if not votes:
+            return
+        column = cls._thing_column()
+        db.statement(
+            "INSERT INTO {table} (user_id, {column}, vote_type) VALUES {values} "
+            "ON CONFLICT (user_id, {column}) DO UPDATE SET vote_type = EXCLUDED.vote_type".format(
+                table=cls.__table__,
+                column=column,
+                values=", ".join(["(%s, %s, %s)"] * len(votes)),
+            ),
+            [x for vote in votes for x in vote],
+        )
+
     @classmethod
     def upvotes_by_user(cls, user):
         return cls.by_user_and_vote_type(user.id, UPVOTE)
@@ -182,38 +357,18 @@ class LinkVote(Vote):
             else "ldv:{}".format(user_id)
         )
 
+    @classmethod
+    def _thing_prefix(cls):
+        return "l:"
+
+    @classmethod
+    def _thing_column(cls):
+        return "link_id"
+
     def commit(self):
         self.apply()
         # change users params (more karma/trust factor or something)
 
-    def apply(self):
-        previous_vote = (
-            LinkVote.where("user_id", self.user_id)
-            .where("link_id", self.link_id)
-            .first()
-        )
-
-        if previous_vote and previous_vote.vote_type == self.vote_type:
-            return
-
-        if previous_vote and previous_vote.affected_attribute:
-            previous_vote.del_from_cache()
-            self.link.decr(previous_vote.affected_attribute, 1)
-
-        if self.affected_attribute:
-            self.link.incr(self.affected_attribute, 1)
-            self.write_to_cache()
-
-        if previous_vote is None:
-            self.save()
-        else:
-            LinkVote.where("user_id", self.user_id).where(
-                "link_id", self.link_id
-            ).update({"vote_type": self.vote_type})
-
-        if self.link.num_votes < 20 or self.link.num_votes % 8 == 0:
-            q.enqueue(JOB_update_link, self.link, result_ttl=0)
-
 
 class CommentVote(Vote):
     __table__ = "comment_votes"
@@ -281,40 +436,83 @@ class CommentVote(Vote):
             else "cdv:{}".format(user_id)
         )
 
+    @classmethod
+    def _thing_prefix(cls):
+        return "c:"
+
+    @classmethod
+    def _thing_column(cls):
+        return "comment_id"
+
     def commit(self):
         self.apply()
         # change users params (more karma/trust factor or something)
 
-    def apply(self):
-        # find previous vote
-        previous_vote = (
-            CommentVote.where("user_id", self.user_id)
-            .where("comment_id", self.comment_id)
-            .first()
-        )
-
-        # nothing to change, shouldn't happen
-        if previous_vote and previous_vote.vote_type == self.vote_type:
-            return
 
-        # undo previous vote
-        if previous_vote and previous_vote.affected_attribute:
-            previous_vote.del_from_cache()
-            self.comment.decr(previous_vote.affected_attribute, 1)
-
-        # apply new vote
-        if self.affected_attribute:
-            self.write_to_cache()
-            self.comment.incr(self.affected_attribute, 1)
-
-        # safe new vote
-        if previous_vote is None:
-            self.save()
-        else:
-            CommentVote.where("user_id", self.user_id).where(
-                "comment_id", self.comment_id
-            ).update({"vote_type": self.vote_type})
-
-        # update comment if needed
-        if self.comment.num_votes < 20 or self.comment.num_votes % 8 == 0:
-            q.enqueue(update_comment, self.comment, result_ttl=0)
+def JOB_flush_votes():
+    """
+    Write pending votes to database and re-rank voted things
+    Pending data are moved to processing keys first and deleted only after they are written,
+    data of failed flush are written by the next one before any newer data
+    """
+    cache.delete(FLUSH_SCHEDULED_KEY)
+
+    def flush(votes, rerank):
+        _write_votes(votes)
+        _rerank(rerank)
+
+    process_pending([PENDING_VOTES_KEY, RERANK_KEY], flush)
+
+
+def _vote_models():
+    return {
+        LinkVote._thing_prefix(): LinkVote,
+        CommentVote._thing_prefix(): CommentVote,
+    }
+
+
+def _split_thing_key(key):
+    """
+    Split thing cache key to prefix and id
+    :param key: cache key
+    :return: (prefix, id)
+    """
+    prefix, id = key.split(":", 1)
+    return prefix + ":", int(id)
+
+
+def _write_votes(entries):
+    """
+    Write votes to database, only the last vote of user on each thing is written
+    :param entries: pending votes
+    """
+    votes = {}
+    for entry in entries:
+        thing, user_id, vote_type = entry.decode().rsplit(":", 2)
+        votes[thing, int(user_id)] = int(vote_type)
+
+    by_model = {}
+    for (thing, user_id), vote_type in votes.items():
+        prefix, id = _split_thing_key(thing)
+        by_model.setdefault(prefix, []).append((user_id, id, vote_type))
+
+    models = _vote_models()
+    for prefix, model_votes in by_model.items():
+        models[prefix].upsert_many(model_votes)
+
+
+def _rerank(things):
+    """
+    Re-rank voted things with their updated counters
+    Links are re-ranked in batches by JOB_update_links
+    :param things: thing cache keys
+    """
+    by_model = {}
+    for thing in things:
+        prefix, id = _split_thing_key(thing.decode())
+        by_model.setdefault(prefix, []).append(id)
+
+    schedule_link_updates(by_model.pop(LinkVote._thing_prefix(), []))
+    for comment in Comment.by_ids(by_model.pop(CommentVote._thing_prefix(), [])):
+        if comment is not None:
+            update_comment(comment)
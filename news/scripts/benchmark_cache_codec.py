@@ -0,0 +1,99 @@
+import timeit
+from datetime import datetime
+
+from news.lib.cache import CODECS, decode
+from news.models.comment import Comment
+from news.models.link import Link
+from news.models.user import User
+
+NOW = datetime(2020, 6, 1, 12, 30, 15, 123456).isoformat()
+
+# attributes as written to cache by Base.write_to_cache
+SAMPLES = {
+    Link: {
+        "id": 1234567,
+        "title": "Show HN: A fast key-value store written in a weekend",
+        "slug": "show-hn-a-fast-key-value-store-written-in-a-weekend",
+        "text": "We needed something small and fast for our side project. " * 4,
+        "image": None,
+        "url": "https://example.com/blog/2020/06/fast-key-value-store",
+        "user_id": 12345,
+        "feed_id": 42,
+        "ups": 153,
+        "downs": 12,
+        "comments_count": 37,
+        "archived": False,
+        "reported": 0,
+        "spam": False,
+        "created_at": NOW,
+        "updated_at": NOW,
+        "textsearchable_title": "'fast':4 'key':5 'key-valu':5 'store':8 'valu':7",
+        "textsearchable_text": "'fast':6 'need':2 'project':10 'side':9 'small':4",
+    },
+    Comment: {
+        "id": 7654321,
+        "parent_id": 7654300,
+        "text": "This is pretty neat, how does it compare to existing solutions?",
+        "user_id": 4321,
+        "link_id": 1234567,
+        "reported": 0,
+        "spam": False,
+        "ups": 5,
+        "downs": 1,
+        "created_at": NOW,
+        "updated_at": NOW,
+    },
+    User: {
+        "id": 4321,
+        "username": "matoous",
+        "full_name": "Matous Dzivjak",
+        "email": "matous@example.com",
+        "email_verified": True,
+        "subscribed": False,
+        "email_public": False,
+        "reported": 0,
+        "spammer": False,
+        "preferred_sort": "trending",
+        "bio": None,
+        "url": None,
+        "feed_subs": 12,
+        "p_infinite_scrolling": True,
+        "p_show_summaries": True,
+        "p_min_link_score": -3,
+        "created_at": NOW,
+        "updated_at": NOW,
+    },
+}
+
+
+def benchmark_cache_codec(number=100000):
+    """
+    Compare size and speed of cache codecs on typical cached models
+    :param number: number of encodings and decodings to time
+    """
+    print(
+        "{:<8} {:<7} {:>6} {:>11} {:>11}".format(
+            "model", "codec", "bytes", "encode us", "decode us"
+        )
+    )
+    for model, attributes in SAMPLES.items():
+        schema = model.__cache_schema__
+        for name, codec in CODECS.items():
+            data = codec.encode(attributes, schema)
+            encode_time = timeit.timeit(
+                lambda: codec.encode(attributes, schema), number=number
+            )
+            decode_time = timeit.timeit(lambda: decode(data, schema), number=number)
+            print(
+                "{:<8} {:<7} {:>6} {:>11.2f} {:>11.2f}".format(
+                    model.__name__,
+                    name,
+                    len(data),
+                    encode_time / number * 1e6,
+                    decode_time / number * 1e6,
+                )
+            )
+
+
+if __name__ == "__main__":
+    benchmark_cache_codec()
@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+
+from news.lib.autocomplete import add_feeds, add_links, LINK_TTL
+from news.models.feed import Feed
+from news.models.link import Link
+
+
+def build_autocomplete(chunk=1000):
+    """
+    Index all feeds and recent links for autocomplete
+    The index is otherwise filled by new feeds and links and updated on subscriptions and renames,
+    rebuilding refreshes scores of all feeds
+    :param chunk: number of items indexed at once
+    """
+    print("Indexing feeds")
+    for feeds in Feed.chunk(chunk):
+        add_feeds(feeds)
+
+    print("Indexing links")
+    since = datetime.utcnow() - timedelta(seconds=LINK_TTL)
+    for links in Link.where("created_at", ">=", since).chunk(chunk):
+        add_links(links)
+    print("Finished")
+
+
+if __name__ == "__main__":
+    build_autocomplete()
@@ -0,0 +1,42 @@
+from time import monotonic, sleep
+
+from news.lib.counters import counters, JOB_flush_counters
+from news.lib.home_listing import drop_inactive_listings, home_listings
+from news.lib.task_queue import q
+
+
+def clock():
+    """
+    Enqueue periodic jobs
+    Runs as single process next to the workers
+    """
+    # [job, interval in seconds, next run]
+    jobs = []
+    if counters.write_behind:
+        print("Flushing counters every {} seconds".format(counters.flush_interval))
+        jobs.append([JOB_flush_counters, counters.flush_interval])
+    if home_listings.enabled:
+        print(
+            "Dropping inactive home listings every {} seconds".format(
+                home_listings.prune_interval
+            )
+        )
+        jobs.append([drop_inactive_listings, home_listings.prune_interval])
+
+    if not jobs:
+        print("Nothing to schedule")
+        return
+
+    for job in jobs:
+        job.append(monotonic() + job[1])
+    while True:
+        sleep(max(0, min(job[2] for job in jobs) - monotonic()))
+        now = monotonic()
+        for job in jobs:
+            if job[2] <= now:
+                q.enqueue(job[0], result_ttl=0)
+                job[2] = now + job[1]
+
+
+if __name__ == "__main__":
+    clock()
@@ -1,15 +1,49 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 
+from news.lib.fqs_fetcher import Fetcher
+from news.lib.fqs_scheduler import next_interval, schedule
 
 BATCH_SIZE = 100
-AUTOPOSTER_ID = 12345
+
+
+def update_sources(sources, fetcher=None):
+    """
+    Update Fully Qualified Sources and schedule their next updates
+    Sources are fetched concurrently and parsed as the fetches complete
+    :param sources: sources
+    :param fetcher: fetcher
+    :return: sources which failed to update
+    """
+    fetcher = fetcher or Fetcher()
+    failed_sources = []
+    for result in fetcher.fetch_all(sources):
+        source = result.source
+        print("Source {} fetched in {:.3f}s".format(source.url, result.elapsed))
+        changed, posted, failed = False, [], False
+        try:
+            if result.error is not None:
+                raise result.error
+            changed = source.changed(result)
+            if changed:
+                posted = source.post_links(source.parse_links(result.data))
+            source.processed(result)
+        except Exception as e:
+            print("couldn't get links for FQS {}, error: {}".format(source.url, e))
+            failed_sources.append(source)
+            failed = True
+        source.next_update = datetime.now() + next_interval(
+            source, changed, len(posted), failed
+        )
+        source.save()
+        schedule([source])
+    return failed_sources
 
 
 def import_fqs():
-    from news.models.link import Link
     from news.models.fully_qualified_source import FullyQualifiedSource
 
     print("Importing Fully Qualified Sources")
+    fetcher = Fetcher()
     while True:
         # Get batch of FQS
         now = datetime.now()
@@ -22,26 +56,4 @@ def import_fqs():
             print("Finished")
             break
 
-        # Check FQS
-        for source in sources:
-            print("Source {}".format(source.url))
-            try:
-                articles = source.get_links()
-            except Exception as e:
-                print("couldn't get links for FQS {}, error: {}".format(source.url, e))
-                articles = []
-            for article in articles:
-                # skip if article already posted
-                if Link.by_slug(article["slug"]) is not None:
-                    continue
-                link = Link(
-                    title=article["title"],
-                    slug=article["slug"],
-                    text=article["text"],
-                    url=article["url"],
-                    feed_id=source.feed_id,
-                    user_id=AUTOPOSTER_ID,
-                )
-                link.commit()
-            source.next_update = now + timedelta(seconds=source.update_interval)
-            source.save()
+        update_sources(sources, fetcher)
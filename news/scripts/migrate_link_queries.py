@@ -0,0 +1,27 @@
+from news.clients.db.query import LinkQuery
+
+
+def migrate_link_queries(storage=None):
+    """
+    Convert all cached link queries into given storage format
+    Run after changing LINK_QUERY_STORAGE, queries are otherwise converted lazily on first access
+    :param storage: target storage, configured storage by default
+    :return: number of converted queries
+    """
+    from news.lib.cache import cache
+
+    print("Migrating link queries")
+    converted = 0
+    for key in cache.scan_iter(match="cquery:*", count=1000):
+        # keys are in format cquery:{feed_id}.{sort}.{time}
+        feed_id, sort, time = key.decode()[len("cquery:") :].split(".", 2)
+        if LinkQuery(feed_id, sort, time=time, storage=storage).migrate():
+            converted += 1
+    print("Finished, converted {} queries".format(converted))
+    return converted
+
+
+if __name__ == "__main__":
+    import sys
+
+    migrate_link_queries(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,29 @@
+from time import sleep
+
+from news.lib.fqs_scheduler import pop_due, sync_schedule
+from news.lib.task_queue import q
+from news.lib.tasks.tasks import JOB_update_fqs
+
+# sources updated by single job
+BATCH_SIZE = 50
+# seconds between checks when no source is due
+TICK = 5
+
+
+def schedule_fqs():
+    """
+    Dispatch updates of Fully Qualified Sources to workers as they become due
+    Runs as single process next to the workers
+    """
+    sync_schedule()
+    print("Scheduling Fully Qualified Sources")
+    while True:
+        due = pop_due(BATCH_SIZE)
+        if due:
+            q.enqueue(JOB_update_fqs, [id for id, _ in due], result_ttl=0)
+        if len(due) < BATCH_SIZE:
+            sleep(TICK)
+
+
+if __name__ == "__main__":
+    schedule_fqs()
@@ -97,6 +97,77 @@ commentComment = function (id, route) {
     return false;
 };
 
+markCommentVotes = function (thread) {
+    [['up', thread.dataset.upvotes], ['down', thread.dataset.downvotes]].forEach(([direction, ids]) => {
+        ids.split(',').filter(id => id !== '').forEach(id => {
+            const vote = thread.querySelector('#c' + id + ' > .comment-voting .' + direction + ' a');
+            if (vote) {
+                vote.href = vote.href.replace(/\/vote\/(up|down)vote/, '/vote/unvote');
+                vote.title = 'Remove the vote';
+                vote.querySelector('img').src = '/static/images/play-light-filled.svg';
+            }
+        });
+    });
+};
+
+document.addEventListener('DOMContentLoaded', () => {
+    document.querySelectorAll('.comment-thread').forEach(markCommentVotes);
+});
+
+loadComments = function (ele) {
+    const more = ele.parentElement;
+    fetch(ele.href, {headers: {'X-Requested-With': 'XMLHttpRequest'}, credentials: 'same-origin'})
+        .then(response => response.ok ? response.text() : Promise.reject(response))
+        .then(html => {
+            more.insertAdjacentHTML('beforebegin', html);
+            markCommentVotes(more.previousElementSibling);
+            more.remove();
+        })
+        .catch(() => {
+            window.location = ele.href;
+        });
+    return false;
+};
+
+autocompleteSearch = function (input, idx) {
+    const list = document.createElement('datalist');
+    list.id = 'autocomplete-' + idx;
+    input.setAttribute('list', list.id);
+    input.setAttribute('autocomplete', 'off');
+    input.parentElement.appendChild(list);
+
+    let routes = {}, timeout = null;
+    input.addEventListener('input', event => {
+        // navigate only when a suggestion is picked, typed text is left to the search form
+        // browsers fire picks as replacement of the text or as a plain event without input type
+        const picked = !(event instanceof InputEvent) || event.inputType === 'insertReplacementText';
+        if (picked && routes[input.value]) {
+            window.location = routes[input.value];
+            return;
+        }
+        clearTimeout(timeout);
+        timeout = setTimeout(() => {
+            fetch('/autocomplete?q=' + encodeURIComponent(input.value))
+                .then(response => response.json())
+                .then(data => {
+                    routes = {};
+                    data.feeds.forEach(feed => routes[feed.name] = feed.route);
+                    data.links.forEach(link => routes[link.title] = link.route);
+                    list.innerHTML = '';
+                    Object.keys(routes).forEach(value => {
+                        const option = document.createElement('option');
+                        option.value = value;
+                        list.appendChild(option);
+                    });
+                });
+        }, 100);
+    });
+};
+
+document.addEventListener('DOMContentLoaded', () => {
+    document.querySelectorAll('form[action="/search"] input[name="q"]').forEach(autocompleteSearch);
+});
+
 if ('serviceWorker' in navigator) {
     // navigator.serviceWorker
     //          .register('./static/scripts/service-worker.js')
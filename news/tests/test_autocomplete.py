@@ -0,0 +1,20 @@
+import unittest
+
+from news.lib.autocomplete import prefixes, MAX_PREFIX
+
+
+class AutocompleteTests(unittest.TestCase):
+    def test_prefixes_of_all_words(self):
+        self.assertEqual(
+            prefixes("World-News a"),
+            {"wo", "wor", "worl", "world", "ne", "new", "news"},
+        )
+
+    def test_prefixes_are_limited(self):
+        word = "a" * (MAX_PREFIX + 5)
+        self.assertEqual(max(len(prefix) for prefix in prefixes(word)), MAX_PREFIX)
+        self.assertEqual(prefixes(None), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
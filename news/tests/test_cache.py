@@ -0,0 +1,62 @@
+import unittest
+from datetime import datetime, timezone
+from pickle import dumps
+
+from news.lib.cache import CODECS, CacheSchema, decode
+
+SCHEMA = CacheSchema(
+    ("id", "int"),
+    ("title", "str"),
+    ("text", "str"),
+    ("score", "float"),
+    ("spam", "bool"),
+    ("created_at", "datetime"),
+)
+
+
+class CacheCodecTests(unittest.TestCase):
+    def test_struct_round_trip(self):
+        attributes = {
+            "id": 12345678901,
+            "title": "Příliš žluťoučký kůň",
+            "text": None,
+            "score": 1.5,
+            "spam": False,
+            "created_at": datetime(2020, 6, 1, 12, 30, 15, 123456),
+        }
+        data = CODECS["struct"].encode(attributes, SCHEMA)
+        self.assertEqual(data[0], CODECS["struct"].version)
+        self.assertEqual(decode(data, SCHEMA), attributes)
+
+    def test_struct_missing_and_extra_attributes(self):
+        data = CODECS["struct"].encode({"id": 1, "textsearchable": "x"}, SCHEMA)
+        self.assertEqual(decode(data, SCHEMA), {"id": 1})
+
+    def test_struct_dates(self):
+        aware = datetime(2020, 6, 1, 14, 0, tzinfo=timezone.utc)
+        for value in [aware, aware.isoformat(), "2020-06-01T14:00:00"]:
+            data = CODECS["struct"].encode({"created_at": value}, SCHEMA)
+            self.assertEqual(
+                decode(data, SCHEMA)["created_at"], datetime(2020, 6, 1, 14, 0)
+            )
+
+    def test_struct_falls_back_to_pickle(self):
+        attributes = {"id": 1, "spam": 0}
+        data = CODECS["struct"].encode(attributes, SCHEMA)
+        self.assertEqual(decode(data, SCHEMA), attributes)
+        self.assertEqual(decode(CODECS["struct"].encode([1, 2])), [1, 2])
+
+    def test_reads_values_of_other_codecs(self):
+        attributes = {"id": 1, "title": "title"}
+        self.assertEqual(decode(dumps(attributes), SCHEMA), attributes)
+        data = CODECS["struct"].encode(attributes, SCHEMA)
+        self.assertEqual(decode(data, SCHEMA), attributes)
+
+    def test_schema_change_is_cache_miss(self):
+        data = CODECS["struct"].encode({"id": 1}, SCHEMA)
+        changed = CacheSchema(("id", "int"), ("title", "str"))
+        self.assertIsNone(decode(data, changed))
+
+
+if __name__ == "__main__":
+    unittest.main()
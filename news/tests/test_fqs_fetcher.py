@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from news.lib.fqs_fetcher import Fetcher, FetchError, interleave_by_host
+
+with open(os.path.join(os.path.dirname(__file__), "fixtures", "feed.xml"), "rb") as f:
+    FEED = f.read()
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    """
+    Serves the fixture feed, /slow responds only after a second
+    Tracks the highest number of concurrent requests
+    """
+
+    etag = '"fixture"'
+
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with FeedHandler.lock:
+            FeedHandler.active += 1
+            FeedHandler.max_active = max(FeedHandler.max_active, FeedHandler.active)
+        try:
+            time.sleep(1 if self.path == "/slow" else 0.05)
+            if self.headers.get("If-None-Match") == self.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/rss+xml")
+            self.send_header("ETag", self.etag)
+            self.send_header("Last-Modified", "Sun, 18 Oct 2026 12:00:00 GMT")
+            self.end_headers()
+            self.wfile.write(FEED)
+        finally:
+            with FeedHandler.lock:
+                FeedHandler.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class FetcherTests(unittest.TestCase):
+    def setUp(self):
+        FeedHandler.max_active = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def source(self, path):
+        return SimpleNamespace(url=self.url + path)
+
+    def test_fetches_all_sources(self):
+        sources = [self.source("/{}".format(i)) for i in range(6)]
+        results = list(Fetcher(workers=4, per_host=4).fetch_all(sources))
+        self.assertEqual({r.source.url for r in results}, {s.url for s in sources})
+        for result in results:
+            self.assertIsNone(result.error)
+            self.assertEqual(result.data, FEED)
+            self.assertGreater(result.elapsed, 0)
+
+    def test_caps_concurrency_per_host(self):
+        sources = [self.source("/{}".format(i)) for i in range(8)]
+        results = list(Fetcher(workers=8, per_host=2).fetch_all(sources))
+        self.assertEqual(len(results), 8)
+        self.assertLessEqual(FeedHandler.max_active, 2)
+
+    def test_timeout_doesnt_stall_other_sources(self):
+        sources = [self.source("/slow")] + [
+            self.source("/{}".format(i)) for i in range(3)
+        ]
+        start = time.monotonic()
+        results = list(Fetcher(workers=4, per_host=4, timeout=0.3).fetch_all(sources))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(results[-1].source.url, self.url + "/slow")
+        self.assertIsNotNone(results[-1].error)
+        self.assertTrue(all(r.data == FEED for r in results[:-1]))
+
+    def test_max_size(self):
+        result = Fetcher(max_size=10).fetch(self.source("/"))
+        self.assertIsInstance(result.error, FetchError)
+
+    def test_conditional_request(self):
+        fetcher = Fetcher()
+        result = fetcher.fetch(self.source("/"))
+        self.assertFalse(result.not_modified)
+        self.assertEqual(result.etag, FeedHandler.etag)
+        self.assertEqual(result.last_modified, "Sun, 18 Oct 2026 12:00:00 GMT")
+
+        source = SimpleNamespace(
+            url=self.url + "/", etag=result.etag, last_modified=result.last_modified
+        )
+        result = fetcher.fetch(source)
+        self.assertIsNone(result.error)
+        self.assertTrue(result.not_modified)
+        self.assertIsNone(result.data)
+
+    def test_interleave_by_host(self):
+        sources = [
+            SimpleNamespace(url=url)
+            for url in [
+                "http://a/1",
+                "http://a/2",
+                "http://a/3",
+                "http://b/1",
+                "http://c/1",
+            ]
+        ]
+        hosts = [s.url[7] for s in interleave_by_host(sources)]
+        self.assertEqual(hosts, ["a", "b", "c", "a", "a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
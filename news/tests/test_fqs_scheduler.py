@@ -0,0 +1,69 @@
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from news.lib.cache import cache
+from news.lib.fqs_scheduler import (
+    INTERVALS_KEY,
+    LEASE,
+    SCHEDULE_KEY,
+    next_interval,
+    pop_due,
+    schedule,
+)
+from news.lib.utils.time_utils import epoch_seconds
+
+
+def source(id, next_update=None, update_interval=timedelta(hours=1)):
+    return SimpleNamespace(
+        id=id, next_update=next_update, update_interval=update_interval
+    )
+
+
+class FqsSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        cache.delete(SCHEDULE_KEY, INTERVALS_KEY)
+
+    def tearDown(self):
+        cache.delete(SCHEDULE_KEY, INTERVALS_KEY)
+
+    def test_pops_due_sources_in_order(self):
+        now = datetime.now()
+        schedule(
+            [
+                source(1, now - timedelta(minutes=1)),
+                source(2, now - timedelta(minutes=5)),
+                source(3, now + timedelta(minutes=5)),
+            ]
+        )
+        self.assertEqual([id for id, _ in pop_due(10)], [2, 1])
+        # popped sources are leased
+        self.assertEqual(pop_due(10), [])
+        self.assertGreaterEqual(
+            cache.zscore(SCHEDULE_KEY, 1), epoch_seconds(now) + LEASE - 1
+        )
+
+    def test_pops_batches(self):
+        now = datetime.now()
+        schedule([source(id, now - timedelta(seconds=id)) for id in range(5)])
+        self.assertEqual(len(pop_due(3)), 3)
+        self.assertEqual(len(pop_due(3)), 2)
+
+    def test_adapts_interval(self):
+        s = source(1)
+        self.assertEqual(next_interval(s, True, 3, False), timedelta(minutes=30))
+        self.assertEqual(next_interval(s, True, 3, False), timedelta(minutes=15))
+        # never faster than quarter of the base interval
+        self.assertEqual(next_interval(s, True, 3, False), timedelta(minutes=15))
+        self.assertEqual(next_interval(s, False, 0, False), timedelta(minutes=22.5))
+        self.assertEqual(next_interval(s, True, 0, True), timedelta(minutes=45))
+
+    def test_backs_off_up_to_limit(self):
+        s = source(1)
+        for _ in range(10):
+            interval = next_interval(s, False, 0, True)
+        self.assertEqual(interval, timedelta(hours=8))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
 import unittest
+from uuid import uuid4
 
 from news import real_make_app
+from news.lib.cache import cache
+from news.lib.ratelimit import LocalLimits, check_rate_limit
 
 TEST_DB = "test.db"
 
@@ -21,7 +24,53 @@ class BasicTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
 
     def test_rate_limit(self):
-        pass
+        key = "rl:test.{}".format(uuid4())
+        for remaining in reversed(range(5)):
+            state = check_rate_limit([key], 5, 60)
+            self.assertTrue(state.allowed)
+            self.assertEqual(state.remaining, remaining)
+
+        state = check_rate_limit([key], 5, 60)
+        self.assertFalse(state.allowed)
+        self.assertEqual(state.remaining, 0)
+        self.assertEqual(state.retry_after, 12)
+        self.assertEqual(state.reset, 60)
+        cache.delete(key)
+
+    def test_rate_limit_checks_all_keys(self):
+        limited, other = "rl:test.{}".format(uuid4()), "rl:test.{}".format(uuid4())
+        check_rate_limit([limited], 1, 60)
+        self.assertFalse(check_rate_limit([other, limited], 1, 60).allowed)
+        # denied request doesn't consume quota of other keys
+        self.assertTrue(check_rate_limit([other], 1, 60).allowed)
+        cache.delete(limited, other)
+
+
+class LocalLimitsTests(unittest.TestCase):
+    def setUp(self):
+        self.limits = LocalLimits()
+        self.limits.size = 2
+
+    def test_rejects_when_bucket_is_empty(self):
+        for _ in range(3):
+            self.assertIsNone(self.limits.check(["a"], 3, 60))
+        state = self.limits.check(["a"], 3, 60)
+        self.assertFalse(state.allowed)
+        self.assertEqual(state.retry_after, 20)
+
+    def test_blocks_keys_rejected_by_redis(self):
+        self.assertIsNone(self.limits.check(["a"], 3, 60))
+        self.limits.block(["a"], 30)
+        state = self.limits.check(["a"], 3, 60)
+        self.assertFalse(state.allowed)
+        self.assertEqual(state.retry_after, 30)
+
+    def test_memory_is_bounded(self):
+        for key in ["a", "b", "c"]:
+            self.limits.check([key], 1, 60)
+        # least recently used bucket was evicted
+        self.assertIsNone(self.limits.check(["a"], 1, 60))
+        self.assertFalse(self.limits.check(["c"], 1, 60).allowed)
 
 
 if __name__ == "__main__":